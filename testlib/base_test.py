@@ -24,8 +24,13 @@
 # proto/ptf/base_test.py in the https://github.com/p4lang/PI
 # repository.
 
-from collections import Counter
+import atexit
+from array import array
+from collections import Counter, deque, namedtuple
+import concurrent.futures
 from functools import wraps, partial
+import hashlib
+import json
 import logging
 import re
 import socket
@@ -47,6 +52,19 @@ from p4.v1 import p4runtime_pb2_grpc
 from p4.config.v1 import p4info_pb2
 import google.protobuf.text_format
 
+from bulk_encode import (stringify_many, pack_fixed_width,
+                         unpack_fixed_width, ipv4s_to_binary, ipv4s_to_int,
+                         ipv6s_to_binary, ipv6s_to_int, macs_to_binary,
+                         macs_to_int)
+import entity_dump
+from grpc_channel import (ChannelOptions, DEFAULT_MAX_MESSAGE_SIZE,
+                          DEFAULT_MAX_REQUEST_BYTES, split_write_request)
+from latency_histogram import LatencyHistogram
+import p4info_cache
+import table_sync
+from p4info_index import (P4InfoIndex, DigestDecoder, PacketInDecoder,
+                          PacketOutEncoder)
+
 # See https://gist.github.com/carymrobbins/8940382
 # functools.partialmethod is introduced in Python 3.4
 class partialmethod(partial):
@@ -113,7 +131,7 @@ def ipv6_to_int(addr):
     """Take an argument 'addr' containing an IPv6 address written in
     standard syntax, e.g. '2001:0db8::3210', and convert it to an
     integer."""
-    bytes_ = socket.inet_pton(socket.AF_INET6, '2001:0db8::3210')
+    bytes_ = socket.inet_pton(socket.AF_INET6, addr)
     # Note: The bytes() call below will throw exception if any
     # elements of bytes_ is outside of the range [0, 255]], so no need
     # to add a separate check for that here.
@@ -182,10 +200,12 @@ class P4RuntimeErrorIterator:
             if not one_error_any.Unpack(p4_error):
                 raise P4RuntimeErrorFormatException(
                     "Cannot convert Any message to p4.Error")
-            if p4_error.canonical_code == code_pb2.OK:
-                continue
             v = self.idx, p4_error
             self.idx += 1
+            # In a batch, the server reports one p4.Error per update,
+            # including OK ones for the updates that succeeded.
+            if p4_error.canonical_code == code_pb2.OK:
+                continue
             return v
         raise StopIteration
 
@@ -280,10 +300,1535 @@ class _AssertP4RuntimeErrorContext(object):
                 self.msg_regexp.pattern, p4_error.message))
         return True
 
+# Raised by undo_write_requests when some of its DELETE batches failed.
+# batch_errors is a list of (batch_index, num_updates, exception)
+# tuples, one per failed batch.
+class P4RuntimeUndoException(Exception):
+    def __init__(self, batch_errors):
+        super(P4RuntimeUndoException, self).__init__()
+        self.batch_errors = batch_errors
+
+    def __str__(self):
+        message = "Error(s) during undo of write requests:\n"
+        for batch_idx, num_updates, e in self.batch_errors:
+            message += "\t* Batch {} ({} updates): {}\n".format(
+                batch_idx, num_updates, str(e).strip())
+        return message
+
+# Sends the WriteRequest 'req' with the P4Runtime stub 'stub', and
+# returns the WriteResponse.  If 'req' is larger than 'max_bytes', its
+# updates are sent in several RPCs (see split_write_request), and the
+# P4RuntimeWriteException raised if some of them fail reports the
+# errors of all RPCs, with their index in 'req', as if it had been sent
+# at once.  If an RPC fails with another gRPC error, that error is
+# raised at once, with the attributes 'write_offset', the index of the
+# first update that was not sent, and 'write_errors', the errors of the
+# updates sent before it, so that the updates that were written can
+# still be accounted for (see written_update_indices).
+def write_split(stub, req, max_bytes):
+    chunks = split_write_request(req, max_bytes)
+    if len(chunks) == 1:
+        try:
+            return stub.Write(req)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNKNOWN:
+                raise e
+            raise P4RuntimeWriteException(e)
+    logging.debug("Splitting WriteRequest of %d bytes in %d requests"
+                  "" % (req.ByteSize(), len(chunks)))
+    exc = None
+    rep = None
+    for offset, chunk in chunks:
+        try:
+            rep = stub.Write(chunk)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNKNOWN:
+                e.write_offset = offset
+                e.write_errors = exc.errors if exc is not None else []
+                raise e
+            chunk_exc = P4RuntimeWriteException(e)
+            errors = [(offset + idx, p4_error)
+                      for idx, p4_error in chunk_exc.errors]
+            if exc is None:
+                exc = chunk_exc
+                exc.errors = errors
+            else:
+                exc.errors.extend(errors)
+    if exc is not None:
+        raise exc
+    return rep
+
+# Returns the indices of the updates of a WriteRequest that were
+# written before write_split raised the gRPC error 'e': none if the
+# request was sent with a single RPC, and otherwise the updates of the
+# RPCs that completed, except those that failed.
+def written_update_indices(e):
+    failed = set(idx for idx, _ in getattr(e, 'write_errors', []))
+    return [idx for idx in range(getattr(e, 'write_offset', 0))
+            if idx not in failed]
+
+# The key of an entity inserted by a test, enough to delete it again.
+# For a table entry, object_id is the table id and key is the match
+# key in canonical form (see table_sync.match_key), serialized as a
+# TableEntry message with only its 'match' field set, so that entries
+# read back from the switch have the same key.  For an action profile
+# member or group, object_id is the action profile id and key the
+# member or group id.  For a digest entry, object_id is the digest id
+# and key is 0.  For other entities, object_id is 0 and key is the
+# whole serialized Entity message.
+JournalRecord = namedtuple('JournalRecord',
+                           ['kind', 'object_id', 'key', 'priority'])
+
+class WriteJournal(object):
+    """Records the entities inserted by the write requests of a test,
+    for autocleanup.  Only one JournalRecord per entity is kept, not
+    the write requests themselves, and DELETE updates remove the
+    records of the entities they delete.  Records are kept in insertion
+    order."""
+
+    def __init__(self):
+        # JournalRecord -> None, used as an insertion ordered set
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def __reversed__(self):
+        return reversed(list(self._records))
+
+    # Same name as list.append, for code that used to store the write
+    # requests in a list.
+    def append(self, req):
+        for update in req.updates:
+            self.record_update(update)
+
+    def record_update(self, update, record=None):
+        # 'record', if given, is make_record(update.entity), already
+        # computed by the caller.
+        if update.type == p4runtime_pb2.Update.INSERT:
+            if record is None:
+                record = self.make_record(update.entity)
+            self._records[record] = None
+        elif update.type == p4runtime_pb2.Update.DELETE:
+            if record is None:
+                record = self.make_record(update.entity)
+            self._records.pop(record, None)
+
+    def discard(self, record):
+        self._records.pop(record, None)
+
+    def clear(self):
+        self._records.clear()
+
+    @staticmethod
+    def make_record(entity):
+        kind = entity.WhichOneof('entity')
+        if kind == 'table_entry':
+            te = entity.table_entry
+            key, priority = table_sync.match_key(te)
+            return JournalRecord(kind, te.table_id, key, priority)
+        if kind == 'action_profile_member':
+            m = entity.action_profile_member
+            return JournalRecord(kind, m.action_profile_id, m.member_id, 0)
+        if kind == 'action_profile_group':
+            g = entity.action_profile_group
+            return JournalRecord(kind, g.action_profile_id, g.group_id, 0)
+        if kind == 'digest_entry':
+            return JournalRecord(kind, entity.digest_entry.digest_id, 0, 0)
+        return JournalRecord(kind, 0,
+                             entity.SerializeToString(deterministic=True), 0)
+
+    @staticmethod
+    def set_delete_update(update, record):
+        update.type = p4runtime_pb2.Update.DELETE
+        entity = update.entity
+        if record.kind == 'table_entry':
+            te = entity.table_entry
+            te.table_id = record.object_id
+            te.MergeFromString(record.key)
+            if record.priority:
+                te.priority = record.priority
+        elif record.kind == 'action_profile_member':
+            m = entity.action_profile_member
+            m.action_profile_id = record.object_id
+            m.member_id = record.key
+        elif record.kind == 'action_profile_group':
+            g = entity.action_profile_group
+            g.action_profile_id = record.object_id
+            g.group_id = record.key
+        elif record.kind == 'digest_entry':
+            entity.digest_entry.digest_id = record.object_id
+        else:
+            entity.MergeFromString(record.key)
+
+class WriteBatch(object):
+    """Accumulates the updates of every WriteRequest passed to
+    P4RuntimeTest.write_request (and thus of all of the send_request_*,
+    table_add and pre_add_mcast_group convenience helpers) into a
+    single WriteRequest, which is sent when it contains 'max_updates'
+    updates, when an update is added while its oldest update has been
+    waiting for more than 'max_delay' seconds, or when flush() is
+    called.  There is no timer: 'max_delay' is only checked when the
+    next update is added, so the last updates of a batch wait for
+    flush(), which is called when the context manager exits, or before
+    any read.  Use it as a context manager through
+    P4RuntimeTest.write_batch():
+
+        with self.write_batch():
+            for i in range(10000):
+                self.table_add(...)
+
+    While a batch is active, the helpers return None instead of the
+    WriteResponse.  If the server rejects some of the updates of a
+    batch, the P4RuntimeWriteException raised by flush() has an extra
+    attribute 'entries', a list of (req, update_index, p4_error)
+    tuples identifying the caller's WriteRequest and the index of the
+    failed update within it.  Only the updates that were accepted are
+    stored for autocleanup.
+
+    A server may apply the updates of one WriteRequest in any order, so
+    the pending updates are flushed before adding an update that
+    depends on one of them:
+
+    - an update of an entity that already has a pending update, e.g. a
+      MODIFY or DELETE of an entry inserted in the same batch;
+    - an update whose type (INSERT, MODIFY or DELETE) differs from the
+      type of the pending updates, so that e.g. deleting an entry and
+      inserting another one that takes its place are not reordered;
+    - an update of an action profile member, an action profile group,
+      or a table entry whose action is a member or group id, while an
+      update of one of the other two is pending (a group refers to its
+      members, such a table entry to its member or group).
+
+    The updates of a caller's WriteRequest are never split between two
+    WriteRequests, and are merged only with requests with the same role
+    and election id, which the merged request keeps.  Requests with an
+    atomicity other than CONTINUE_ON_ERROR are never merged: they are
+    sent on their own, after flushing the pending updates."""
+
+    # Kinds of entities that may refer to each other, see above
+    _REFERENCING_KINDS = frozenset(['action_profile_member',
+                                    'action_profile_group',
+                                    'table_entry_ap'])
+
+    def __init__(self, test, max_updates=1000, max_delay=0.5,
+                 raise_errors=True):
+        assert max_updates > 0
+        self.test = test
+        self.max_updates = max_updates
+        self.max_delay = max_delay
+        self.raise_errors = raise_errors
+        # (req, update_index, p4_error) tuples of all failed updates,
+        # useful when raise_errors is False
+        self.errors = []
+        self.num_requests = 0
+        self.num_updates = 0
+        self._prev_batch = None
+        self._reset()
+
+    def _reset(self):
+        self.req = p4runtime_pb2.WriteRequest()
+        self.req.device_id = self.test.device_id
+        # One (req, update_index, store, journal record) tuple per
+        # update in self.req
+        self._origins = []
+        # Journal records of the entities with a pending update
+        self._keys = set()
+        # Kinds of _REFERENCING_KINDS with a pending update
+        self._kinds = set()
+        # Type of the pending updates
+        self._type = None
+        self._first_time = None
+
+    def __len__(self):
+        return len(self._origins)
+
+    @staticmethod
+    def _header(req):
+        # The fields set in 'req' other than its updates, e.g. role and
+        # election_id, whatever the version of p4runtime.proto
+        return [(field, value) for field, value in req.ListFields()
+                if field.name not in ('device_id', 'updates')]
+
+    @staticmethod
+    def _kind(entity):
+        kind = entity.WhichOneof('entity')
+        if kind == 'table_entry' and \
+                entity.table_entry.action.WhichOneof('type') in (
+                    'action_profile_member_id', 'action_profile_group_id'):
+            return 'table_entry_ap'
+        return kind
+
+    def _conflicts(self, update_type, record, kind):
+        if self._type is not None and update_type != self._type:
+            return True
+        if record in self._keys:
+            return True
+        if kind in self._REFERENCING_KINDS:
+            return len(self._kinds) > 1 or (len(self._kinds) == 1 and
+                                            kind not in self._kinds)
+        return False
+
+    def _track(self, update_type, record, kind):
+        self._type = update_type
+        self._keys.add(record)
+        if kind in self._REFERENCING_KINDS:
+            self._kinds.add(kind)
+
+    def add(self, req, store=True):
+        if req.atomicity != p4runtime_pb2.WriteRequest.CONTINUE_ON_ERROR:
+            self.flush()
+            self.num_requests += 1
+            self.num_updates += len(req.updates)
+            self.test._write(req)
+            if store:
+                self.test._reqs.append(req)
+            return
+        records = [(u.type, WriteJournal.make_record(u.entity),
+                    self._kind(u.entity)) for u in req.updates]
+        header = self._header(req)
+        if len(self._origins) > 0 and (
+                header != self._header(self.req) or
+                any(self._conflicts(*r) for r in records)):
+            self.flush()
+        if len(self._origins) == 0:
+            for field, value in header:
+                if field.message_type is not None:
+                    getattr(self.req, field.name).CopyFrom(value)
+                else:
+                    setattr(self.req, field.name, value)
+        if self._first_time is None:
+            self._first_time = time.time()
+        self.req.updates.extend(req.updates)
+        for i, (update_type, record, kind) in enumerate(records):
+            self._origins.append((req, i, store, record))
+            self._track(update_type, record, kind)
+        self._maybe_flush()
+
+    def emit(self, builder, row, store=True):
+        """Add the table entry built by TableEntryBuilder 'builder'
+        from 'row' directly to the pending WriteRequest.  In the
+        'entries' of a P4RuntimeWriteException, such an update is
+        reported as (row, 0, p4_error)."""
+        if self._first_time is None:
+            self._first_time = time.time()
+        update = builder.emit(self.req, row)
+        record = WriteJournal.make_record(update.entity)
+        kind = self._kind(update.entity)
+        if self._conflicts(update.type, record, kind):
+            # Send the entry just added in the next request.
+            pending = p4runtime_pb2.Update()
+            pending.CopyFrom(update)
+            del self.req.updates[-1]
+            try:
+                self.flush()
+            finally:
+                self._first_time = time.time()
+                self.req.updates.add().CopyFrom(pending)
+                self._origins.append((row, 0, store, record))
+                self._track(pending.type, record, kind)
+            self._maybe_flush()
+            return
+        self._origins.append((row, 0, store, record))
+        self._track(update.type, record, kind)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (len(self._origins) >= self.max_updates or
+                time.time() - self._first_time >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        if len(self._origins) == 0:
+            return
+        req = self.req
+        origins = self._origins
+        self._reset()
+        self.num_requests += 1
+        self.num_updates += len(origins)
+        failed = {}
+        exc = None
+        journal = self.test._reqs
+        try:
+            self.test._write(req)
+        except P4RuntimeWriteException as e:
+            exc = e
+            failed = dict(e.errors)
+        except grpc.RpcError as e:
+            # Store what was written before the error, if the request
+            # was split.
+            for idx in written_update_indices(e):
+                if origins[idx][2]:
+                    journal.record_update(req.updates[idx], origins[idx][3])
+            raise
+        for idx, (orig_req, update_idx, store, record) in enumerate(origins):
+            if store and idx not in failed:
+                journal.record_update(req.updates[idx], record)
+        if exc is None:
+            return
+        entries = []
+        for idx, p4_error in exc.errors:
+            orig_req, update_idx, _, _ = origins[idx]
+            entries.append((orig_req, update_idx, p4_error))
+        self.errors.extend(entries)
+        exc.entries = entries
+        if self.raise_errors:
+            raise exc
+        logging.error("WriteBatch: %d of %d updates failed:\n%s"
+                      "" % (len(entries), len(origins), exc))
+
+    def __enter__(self):
+        self._prev_batch = self.test._write_batch
+        self.test._write_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.test._write_batch = self._prev_batch
+        if exc_type is None:
+            self.flush()
+            return False
+        # Do not let an error while flushing hide the original one.
+        try:
+            self.flush()
+        except Exception as e:
+            logging.error("WriteBatch: error while flushing: %s" % (e))
+        return False
+
+def _to_bytes(v):
+    # Same result as stringify(v) for an int, without its checks.
+    # bytes values, e.g. the full width ones of the bulk encoders, are
+    # only put in the same canonical form, without leading zero bytes.
+    if type(v) is bytes:
+        return v.lstrip(b'\x00') or b'\x00'
+    return v.to_bytes(((v.bit_length() + 7) // 8) or 1, byteorder='big')
+
+class TableEntryBuilder(object):
+    """Builds table entries for one table, with a fixed list of match
+    fields and one action, from plain tuples of values.  All P4Info ids,
+    bitwidths and match kinds are resolved once, when the builder is
+    created with P4RuntimeTest.compile_table_entry(), and emit() writes
+    the entry directly into an update of the given WriteRequest.
+
+    A row is a tuple with one element per match field, followed by one
+    element per action parameter, followed by the priority if the
+    builder was created with priority=True.  The element for a match
+    field depends on its match kind:
+
+        exact:    value
+        lpm:      (value, prefix_len)
+        ternary:  (value, mask)
+        range:    (low, high)
+        optional: value, or None for a wildcard
+
+    Values are non-negative ints, or big endian bytes of any width, e.g.
+    as returned by the bulk encoders.  Both are encoded like stringify()
+    does, in the fewest bytes, as P4Runtime requires.  A row with
+    another number of elements raises ValueError.  As for the
+    P4RuntimeTest.MF classes, match fields that are completely wildcard
+    are omitted from the entry."""
+
+    EXACT = p4info_pb2.MatchField.EXACT
+    LPM = p4info_pb2.MatchField.LPM
+    TERNARY = p4info_pb2.MatchField.TERNARY
+    RANGE = p4info_pb2.MatchField.RANGE
+    OPTIONAL = p4info_pb2.MatchField.OPTIONAL
+
+    def __init__(self, table_id, match_fields, action_id, param_ids,
+                 priority=False):
+        self.table_id = table_id
+        # (id, bitwidth, match_type) of each match field
+        self.match_fields = match_fields
+        self.action_id = action_id
+        self.param_ids = param_ids
+        self.priority = priority
+        self.num_match_fields = len(match_fields)
+        self.row_len = len(match_fields) + len(param_ids) + int(priority)
+
+    def emit(self, req, row, update_type=p4runtime_pb2.Update.INSERT):
+        if len(row) != self.row_len:
+            raise ValueError("Row %r has %d elements instead of %d"
+                             "" % (row, len(row), self.row_len))
+        update = req.updates.add()
+        update.type = update_type
+        table_entry = update.entity.table_entry
+        table_entry.table_id = self.table_id
+        match = table_entry.match
+        i = 0
+        for mf_id, bitwidth, match_type in self.match_fields:
+            v = row[i]
+            i += 1
+            if match_type == self.EXACT:
+                mf = match.add()
+                mf.field_id = mf_id
+                mf.exact.value = _to_bytes(v)
+            elif match_type == self.LPM:
+                value, prefix_len = v
+                if prefix_len == 0:
+                    continue
+                if type(value) is bytes:
+                    value = int.from_bytes(value, byteorder='big')
+                mf = match.add()
+                mf.field_id = mf_id
+                mf.lpm.prefix_len = prefix_len
+                prefix_mask = (((1 << prefix_len) - 1) <<
+                               (bitwidth - prefix_len))
+                mf.lpm.value = _to_bytes(value & prefix_mask)
+            elif match_type == self.TERNARY:
+                value, mask = v
+                if type(value) is bytes:
+                    value = int.from_bytes(value, byteorder='big')
+                if type(mask) is bytes:
+                    mask = int.from_bytes(mask, byteorder='big')
+                if mask == 0:
+                    continue
+                mf = match.add()
+                mf.field_id = mf_id
+                mf.ternary.value = _to_bytes(value & mask)
+                mf.ternary.mask = _to_bytes(mask)
+            elif match_type == self.RANGE:
+                low, high = v
+                if type(low) is bytes:
+                    low = int.from_bytes(low, byteorder='big')
+                if type(high) is bytes:
+                    high = int.from_bytes(high, byteorder='big')
+                if low == 0 and high == (1 << bitwidth) - 1:
+                    continue
+                mf = match.add()
+                mf.field_id = mf_id
+                mf.range.low = _to_bytes(low)
+                mf.range.high = _to_bytes(high)
+            elif match_type == self.OPTIONAL:
+                if v is None:
+                    continue
+                mf = match.add()
+                mf.field_id = mf_id
+                mf.optional.value = _to_bytes(v)
+        action = table_entry.action.action
+        action.action_id = self.action_id
+        for param_id in self.param_ids:
+            param = action.params.add()
+            param.param_id = param_id
+            param.value = _to_bytes(row[i])
+            i += 1
+        if self.priority:
+            table_entry.priority = row[i]
+        return update
+
+    def emit_many(self, req, rows, update_type=p4runtime_pb2.Update.INSERT):
+        for row in rows:
+            self.emit(req, row, update_type)
+
+class P4RuntimePipeline(object):
+    """Issues Write and Read RPCs without waiting for the previous ones
+    to complete, keeping at most 'window' of them in flight.  write()
+    and read() block only while the window is full, and return a
+    concurrent.futures.Future for the WriteResponse, or for the list of
+    ReadResponse messages, respectively.
+
+    Writes submitted with the same non-None 'key' are issued in
+    submission order, each one only after the previous one completed.
+    Use e.g. the table name as the key when a later request depends on
+    an earlier one, such as a MODIFY of an entry inserted just before.
+    Writes without a key may complete in any order.
+
+    Use it as a context manager through P4RuntimeTest.pipeline(); on
+    exit, it waits for all RPCs to complete and raises the first error,
+    if any.  Successful writes with store=True are stored for
+    autocleanup, in the order in which they completed."""
+
+    def __init__(self, test, window=16):
+        assert window > 0
+        self.test = test
+        self.window = window
+        # (req, exception) tuples of all failed RPCs
+        self.failures = []
+        self._slots = threading.BoundedSemaphore(window)
+        self._lock = threading.Lock()
+        self._pending = set()
+        # ordering key -> Future of the last write submitted with it
+        self._tails = {}
+        self._executor = None
+
+    def write(self, req, store=True, key=None):
+        self._slots.acquire()
+        fut = concurrent.futures.Future()
+        with self._lock:
+            self._pending.add(fut)
+            prev = None
+            if key is not None:
+                prev = self._tails.get(key)
+                self._tails[key] = fut
+
+        def issue(_=None):
+            try:
+                call = self.test.stub.Write.future(req)
+            except Exception as e:
+                self._finish(fut, key, req, exc=e)
+                return
+            call.add_done_callback(
+                lambda c: self._write_done(fut, key, req, store, c))
+
+        if prev is None:
+            issue()
+        else:
+            # Runs immediately if prev already completed.
+            prev.add_done_callback(issue)
+        return fut
+
+    def _write_done(self, fut, key, req, store, call):
+        try:
+            rep = call.result()
+        except grpc.RpcError as e:
+            exc = e
+            if e.code() == grpc.StatusCode.UNKNOWN:
+                try:
+                    exc = P4RuntimeWriteException(e)
+                except P4RuntimeErrorFormatException as format_exc:
+                    exc = format_exc
+            self._finish(fut, key, req, exc=exc)
+            return
+        if store:
+            self.test._reqs.append(req)
+        self._finish(fut, key, req, result=rep)
+
+    def read(self, req):
+        self._slots.acquire()
+        fut = concurrent.futures.Future()
+        with self._lock:
+            self._pending.add(fut)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.window)
+
+        def do_read():
+            try:
+                responses = list(self.test.stub.Read(req))
+            except Exception as e:
+                self._finish(fut, None, req, exc=e)
+                return
+            self._finish(fut, None, req, result=responses)
+
+        self._executor.submit(do_read)
+        return fut
+
+    def _finish(self, fut, key, req, result=None, exc=None):
+        with self._lock:
+            self._pending.discard(fut)
+            if key is not None and self._tails.get(key) is fut:
+                del self._tails[key]
+            if exc is not None:
+                self.failures.append((req, exc))
+        self._slots.release()
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def drain(self, raise_errors=True):
+        """Wait until all submitted RPCs have completed.  If
+        'raise_errors' is True, raise the exception of the first one
+        that failed, if any."""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if len(pending) == 0:
+                break
+            concurrent.futures.wait(pending)
+        if raise_errors and len(self.failures) > 0:
+            raise self.failures[0][1]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.drain(raise_errors=(exc_type is None))
+        finally:
+            self.close()
+        return False
+
+class StreamMessage(object):
+    """A message received from the server on the StreamChannel, and the
+    value of time.time() when it was received.  msginfo['message'] and
+    msginfo['time'] work too, for code written when these were dicts."""
+    __slots__ = ('time', 'message')
+
+    def __init__(self, time_, message):
+        self.time = time_
+        self.message = message
+
+    def __getitem__(self, key):
+        if key not in StreamMessage.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "StreamMessage(time=%r, message=%s)" % (self.time,
+                                                       self.message)
+
+class StreamInQueue(object):
+    """Stores the StreamMessage records of the messages received from
+    the server on the StreamChannel, in a separate FIFO for each type
+    of message, i.e. for each possible value of the 'update' oneof of
+    StreamMessageResponse: 'arbitration', 'packet', 'digest',
+    'idle_timeout_notification', 'other' and 'error'.
+
+    get() waits only for messages of the requested type, so messages of
+    other types are kept until a caller asks for them.
+
+    Each FIFO holds at most 'capacity' messages, or capacity[type] if
+    'capacity' is a dict (no limit for types not in the dict, or if
+    'capacity' is None).  When a message arrives for a full FIFO,
+    'policy' decides what happens:
+
+        'drop-oldest': the oldest message in the FIFO is dropped
+        'drop-newest': the new message is dropped
+        'block':       put() waits until a message is removed, which
+                       stops reading the stream, and thus makes gRPC
+                       flow control slow down the server
+
+    stats() returns the number of messages received, dropped and
+    currently retained for each type."""
+
+    TYPES = ('arbitration', 'packet', 'digest', 'idle_timeout_notification',
+             'other', 'error')
+    POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+    def __init__(self, capacity=None, policy='drop-oldest'):
+        assert policy in self.POLICIES
+        self.capacity = capacity
+        self.policy = policy
+        self._lock = threading.Lock()
+        # Notified when a message of any type is put
+        self._any_cond = threading.Condition(self._lock)
+        # Notified when a message is removed, for the 'block' policy
+        self._not_full = threading.Condition(self._lock)
+        # type -> deque of (sequence number, StreamMessage)
+        self._queues = {}
+        # type -> Condition notified when a message of that type is put
+        self._conds = {}
+        # type -> number of messages received / dropped
+        self._received = Counter()
+        self._dropped = Counter()
+        for type_ in self.TYPES:
+            self._add_type(type_)
+        self._seq = 0
+        # Set by close(), after which put() drops all messages
+        self.closed = False
+
+    def _add_type(self, type_):
+        # Must be called with self._lock held, or from __init__
+        self._queues[type_] = deque()
+        self._conds[type_] = threading.Condition(self._lock)
+
+    def _capacity(self, type_):
+        if isinstance(self.capacity, dict):
+            return self.capacity.get(type_)
+        return self.capacity
+
+    def put(self, msginfo):
+        type_ = msginfo.message.WhichOneof('update')
+        with self._lock:
+            if type_ not in self._queues:
+                self._add_type(type_)
+            q = self._queues[type_]
+            self._received[type_] += 1
+            if self.closed:
+                self._dropped[type_] += 1
+                return
+            capacity = self._capacity(type_)
+            if capacity is not None:
+                if self.policy == 'block':
+                    # Bounded waits, in case close() is never called
+                    while len(q) >= capacity and not self.closed:
+                        self._not_full.wait(1.0)
+                    if self.closed:
+                        self._dropped[type_] += 1
+                        return
+                elif len(q) >= capacity:
+                    self._dropped[type_] += 1
+                    if self.policy == 'drop-newest':
+                        return
+                    q.popleft()
+            q.append((self._seq, msginfo))
+            self._seq += 1
+            self._conds[type_].notify()
+            self._any_cond.notify()
+
+    def close(self):
+        """Stop accepting messages: put() drops them from now on, and
+        returns at once if it is blocked with the 'block' policy, so
+        that the thread receiving the stream never waits for a queue
+        that nobody reads any more."""
+        with self._lock:
+            self.closed = True
+            self._not_full.notify_all()
+
+    def _pop(self, type_):
+        # Must be called with self._lock held
+        if type_ is not None:
+            q = self._queues.get(type_)
+            if not q:
+                return None
+        else:
+            q = None
+            for q2 in self._queues.values():
+                if q2 and (q is None or q2[0][0] < q[0][0]):
+                    q = q2
+            if q is None:
+                return None
+        if self.policy == 'block':
+            self._not_full.notify_all()
+        return q.popleft()[1]
+
+    def get(self, type_=None, timeout=None):
+        """Remove and return the oldest StreamMessage of type 'type_', or
+        of any type if 'type_' is None, waiting up to 'timeout' seconds
+        (forever if None) for one to arrive.  Return None on timeout."""
+        if type_ is None:
+            cond = self._any_cond
+        else:
+            with self._lock:
+                if type_ not in self._conds:
+                    self._add_type(type_)
+                cond = self._conds[type_]
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                msginfo = self._pop(type_)
+                if msginfo is not None:
+                    return msginfo
+                if deadline is None:
+                    cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                cond.wait(remaining)
+
+    def qsize(self, type_=None):
+        with self._lock:
+            if type_ is not None:
+                return len(self._queues.get(type_, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def empty(self, type_=None):
+        return self.qsize(type_) == 0
+
+    def stats(self):
+        with self._lock:
+            return {type_: {'received': self._received[type_],
+                            'dropped': self._dropped[type_],
+                            'retained': len(q)}
+                    for type_, q in self._queues.items()}
+
+class StreamRecorder(object):
+    """Keeps the last 'size' StreamMessage records received on a
+    StreamChannel, without converting them to text, so that they can be
+    written out with dump() after a test failed, instead of logging
+    every message at DEBUG level while the test runs."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._msgs = deque(maxlen=size)
+
+    def record(self, msginfo):
+        self._msgs.append(msginfo)
+
+    def __len__(self):
+        return len(self._msgs)
+
+    def clear(self):
+        self._msgs.clear()
+
+    def messages(self):
+        return list(self._msgs)
+
+    def dump(self, fname=None):
+        """Write the recorded messages in protobuf text format, each
+        preceded by its receive time, to the file named 'fname', or to
+        the log at INFO level if 'fname' is None."""
+        msgs = self.messages()
+        if fname is None:
+            logging.info("StreamRecorder: last %d stream messages received"
+                         "" % (len(msgs)))
+            for msginfo in msgs:
+                logging.info("time %.6f: %s" % (msginfo.time,
+                                                msginfo.message))
+            return
+        with open(fname, 'w') as f:
+            for msginfo in msgs:
+                f.write("# time %.6f\n" % (msginfo.time))
+                f.write(google.protobuf.text_format.MessageToString(
+                    msginfo.message))
+                f.write("\n")
+
+class PacketLatencyProbe(object):
+    """Measures the round trip latency of PacketOut messages sent to
+    the switch that come back to the controller as PacketIn messages,
+    e.g. through the CPU port, and records it in a LatencyHistogram.
+
+    send() records the value of time.time() just before a PacketOut is
+    queued in stream_out_q, and collect() matches PacketIns to the
+    PacketOuts sent, and records the difference with the time at which
+    stream_recv received them (StreamMessage.time).  The latency thus
+    includes the time spent in stream_out_q and stream_in_q.
+
+    PacketOuts are matched to PacketIns by the key returned by
+    key(payload), which must be the same for the payload sent and the
+    payload received.  If 'tag' is True, send() appends a 12 byte tag,
+    made of TAG_MAGIC and a sequence number, to each payload, and the
+    default key is that tag, found at the end of the PacketIn payload.
+    Otherwise the default key is the whole payload, which must then be
+    unique among the packets in flight."""
+
+    TAG_MAGIC = b'LAT1'
+    TAG_LEN = 12
+
+    def __init__(self, test, key=None, tag=True, histogram=None):
+        self.test = test
+        self.tag = tag
+        if key is None:
+            key = self.tag_of if tag else bytes
+        self.key = key
+        if histogram is None:
+            histogram = LatencyHistogram()
+        self.histogram = histogram
+        self._seq = 0
+        # key -> time.time() when the PacketOut was sent
+        self._pending = {}
+        # StreamMessage records of PacketIns that matched no PacketOut
+        self.unmatched = []
+
+    @classmethod
+    def tag_of(cls, payload):
+        t = payload[-cls.TAG_LEN:]
+        if len(t) == cls.TAG_LEN and t[:len(cls.TAG_MAGIC)] == cls.TAG_MAGIC:
+            return t
+        return None
+
+    def send(self, packet, timeout=None):
+        """Send 'packet', a PacketOut, or a StreamMessageRequest
+        containing one, e.g. from PacketOutEncoder.encode(), and return
+        its key.  A StreamMessageRequest is modified in place if 'tag'
+        is True."""
+        if isinstance(packet, p4runtime_pb2.PacketOut):
+            req = p4runtime_pb2.StreamMessageRequest()
+            req.packet.CopyFrom(packet)
+        else:
+            req = packet
+        if self.tag:
+            req.packet.payload += (self.TAG_MAGIC +
+                                   self._seq.to_bytes(8, byteorder='big'))
+            self._seq += 1
+        k = self.key(req.packet.payload)
+        assert k not in self._pending
+        self._pending[k] = time.time()
+        self.test.session.send(req, timeout)
+        return k
+
+    def pending(self):
+        """Return the number of PacketOuts sent whose PacketIn has not
+        been received yet."""
+        return len(self._pending)
+
+    def collect(self, timeout=1):
+        """Match the PacketIns in stream_in_q to the PacketOuts sent,
+        until all of them have come back, or no PacketIn was received
+        for 'timeout' seconds.  PacketIns that match no PacketOut are
+        appended to 'unmatched'.  Returns the number of PacketIns
+        matched."""
+        get = self.test.stream_in_q.get
+        key = self.key
+        pending = self._pending
+        record = self.histogram.record
+        matched = 0
+        while pending:
+            msginfo = get("packet", timeout)
+            if msginfo is None:
+                break
+            sent = pending.pop(key(msginfo.message.packet.payload), None)
+            if sent is None:
+                self.unmatched.append(msginfo)
+                continue
+            record(msginfo.time - sent)
+            matched += 1
+        return matched
+
+    def report(self):
+        """Return the summary of the histogram, see
+        LatencyHistogram.summary(), with the number of PacketOuts still
+        'pending' and of 'unmatched' PacketIns."""
+        d = self.histogram.summary()
+        d['pending'] = len(self._pending)
+        d['unmatched'] = len(self.unmatched)
+        return d
+
+    def to_json(self, fname=None):
+        """Like LatencyHistogram.to_json(), with the counts of
+        report() added."""
+        d = self.histogram.to_dict()
+        d['pending'] = len(self._pending)
+        d['unmatched'] = len(self.unmatched)
+        s = json.dumps(d, indent=2)
+        if fname is not None:
+            with open(fname, 'w') as f:
+                f.write(s)
+                f.write("\n")
+        return s
+
+class DigestConsumer(object):
+    """Receives the DigestList messages of a test's session, decodes
+    them with one DigestDecoder per digest, and acknowledges them.
+
+    The DigestListAck messages are not sent one by one as each
+    DigestList is received, but 'ack_batch' at a time, once the lists
+    they acknowledge have been received by receive(), or decoded by
+    poll(), and at the end of every call to those.  The ack_timeout_ns
+    of the digest configuration (see
+    P4RuntimeTest.send_request_add_digest) must leave enough time for
+    that.  If poll() fails to decode the lists, none of them is
+    acknowledged, so that the switch sends them again.
+
+    stats() returns the number of DigestLists, digests and acks
+    processed, and the rate of digests per second, measured from the
+    first DigestList received to the last."""
+
+    def __init__(self, test, ack_batch=64):
+        self.test = test
+        self.ack_batch = ack_batch
+        # digest id -> DigestDecoder
+        self._decoders = {}
+        # StreamMessageRequest messages with a DigestListAck not sent yet
+        self._acks = []
+        self.lists = 0
+        self.digests = 0
+        self.acks = 0
+        self._first_time = None
+        self._last_time = None
+
+    def decoder(self, digest_id):
+        d = self._decoders.get(digest_id)
+        if d is None:
+            d = DigestDecoder(self.test.p4info_index.digests[digest_id])
+            self._decoders[digest_id] = d
+        return d
+
+    def _ack(self, digest_list):
+        req = p4runtime_pb2.StreamMessageRequest()
+        req.digest_ack.digest_id = digest_list.digest_id
+        req.digest_ack.list_id = digest_list.list_id
+        self._acks.append(req)
+        if len(self._acks) >= self.ack_batch:
+            self.flush_acks()
+
+    def flush_acks(self):
+        send = self.test.session.send
+        for req in self._acks:
+            send(req)
+        self.acks += len(self._acks)
+        self._acks = []
+
+    def _receive(self, max_lists, timeout):
+        ret = []
+        get = self.test.stream_in_q.get
+        while max_lists is None or len(ret) < max_lists:
+            msginfo = get("digest", timeout if len(ret) == 0 else 0)
+            if msginfo is None:
+                break
+            digest_list = msginfo.message.digest
+            if self._first_time is None:
+                self._first_time = msginfo.time
+            self._last_time = msginfo.time
+            self.lists += 1
+            self.digests += len(digest_list.data)
+            ret.append(digest_list)
+        return ret
+
+    def _ack_all(self, digest_lists):
+        try:
+            for digest_list in digest_lists:
+                self._ack(digest_list)
+        finally:
+            self.flush_acks()
+
+    def receive(self, max_lists=None, timeout=1):
+        """Remove and return the DigestList messages received so far,
+        up to 'max_lists' of them, waiting up to 'timeout' seconds for
+        the first one, and acknowledge them."""
+        ret = self._receive(max_lists, timeout)
+        self._ack_all(ret)
+        return ret
+
+    def poll(self, max_lists=None, timeout=1, columns=False):
+        """Receive DigestLists like receive(), and return a dict mapping
+        the name of each digest received to the list of its digests,
+        decoded by DigestDecoder.decode(), or to its columns, decoded by
+        DigestDecoder.decode_batch(), if 'columns' is True."""
+        received = self._receive(max_lists, timeout)
+        by_id = {}
+        for digest_list in received:
+            by_id.setdefault(digest_list.digest_id, []).append(digest_list)
+        ret = {}
+        for digest_id, digest_lists in by_id.items():
+            decoder = self.decoder(digest_id)
+            if columns:
+                ret[decoder.name] = decoder.decode_batch(digest_lists)
+            else:
+                records = []
+                for digest_list in digest_lists:
+                    records.extend(decoder.decode(digest_list))
+                ret[decoder.name] = records
+        self._ack_all(received)
+        return ret
+
+    def stats(self):
+        seconds = None
+        rate = None
+        if self._first_time is not None:
+            seconds = self._last_time - self._first_time
+            if seconds > 0:
+                rate = self.digests / seconds
+        return {'lists': self.lists, 'digests': self.digests,
+                'acks': self.acks, 'seconds': seconds,
+                'digests_per_second': rate}
+
+# One sample of one counter taken by CounterSampler.  'packets' and
+# 'bytes' are array('Q') of the counter values, one per index (for a
+# direct counter, one per table entry, see CounterSampler.keys).  The
+# deltas, array('q'), are the differences with the previous sample, and
+# the rates, array('d'), are the deltas divided by 'interval', the
+# seconds since the previous sample.  Deltas, rates and interval are
+# None in the first sample.
+CounterSample = namedtuple('CounterSample',
+                           ['time', 'interval', 'packets', 'bytes',
+                            'packet_deltas', 'byte_deltas',
+                            'packet_rates', 'byte_rates'])
+
+class CounterSampler(object):
+    """Reads the counters 'counters', every 'interval' seconds, in a
+    background thread, and keeps the last 'history' CounterSample
+    records of each.  'counters' is a sequence of (kind, name) tuples,
+    with kind 'counter' or 'direct_counter', or of counter names.
+
+    The ReadRequests are built once, and all counters are read with a
+    single RPC when possible (see P4RuntimeTest.read_entities).  Values
+    are kept in arrays of the array module, one element per counter
+    index, which NumPy can use without a copy, e.g. with
+    numpy.frombuffer(sample.packet_rates).
+
+    Use it as a context manager, or call start() and stop().  stop()
+    raises the exception that stopped the sampling thread, if any.
+    sample() can also be called directly, without the thread."""
+
+    def __init__(self, test, counters, interval=1.0, history=60):
+        self.test = test
+        self.interval = interval
+        objects = []
+        for c in counters:
+            if isinstance(c, str):
+                c = ('counter', c)
+            assert c[0] in ('counter', 'direct_counter')
+            objects.append(c)
+        self.counters = [name for _, name in objects]
+        self._reqs, self._owners = test.make_read_entities_requests(objects)
+        self._lock = threading.Lock()
+        # counter name -> deque of CounterSample
+        self._samples = {name: deque(maxlen=history)
+                         for name in self.counters}
+        # direct counter name -> list of the serialized match key and
+        # priority of the table entry of each index, and the inverse
+        # dict
+        self._keys = {}
+        self._key_index = {}
+        # counter name -> size, for indexed counters
+        self._sizes = {}
+        for kind, name in objects:
+            if kind == 'direct_counter':
+                self._keys[name] = []
+                self._key_index[name] = {}
+            else:
+                self._sizes[name] = test.get_counter(name).size
+        self._thread = None
+        self._stop = threading.Event()
+        self.error = None
+
+    def _slot(self, name, entry):
+        te = entry.table_entry
+        match_only = p4runtime_pb2.TableEntry()
+        match_only.match.extend(te.match)
+        match_only.priority = te.priority
+        key = match_only.SerializeToString(deterministic=True)
+        slots = self._key_index[name]
+        idx = slots.get(key)
+        if idx is None:
+            idx = len(self._keys[name])
+            slots[key] = idx
+            self._keys[name].append(key)
+        return idx
+
+    def sample(self):
+        """Read all counters once, and return a dict mapping each
+        counter name to its new CounterSample."""
+        entries = {owner: [] for owner in self._owners.values()}
+        for req in self._reqs:
+            self.test.demux_read_responses(self.test.stub.Read(req),
+                                           self._owners, entries)
+        now = time.time()
+        ret = {}
+        for (kind, name), counter_entries in entries.items():
+            if kind == 'counter':
+                indexes = [entry.index.index for entry in counter_entries]
+                size = self._sizes[name]
+            else:
+                indexes = [self._slot(name, entry)
+                           for entry in counter_entries]
+                size = len(self._keys[name])
+            packets = array('Q', bytes(8 * size))
+            bytes_ = array('Q', bytes(8 * size))
+            for idx, entry in zip(indexes, counter_entries):
+                packets[idx] = entry.data.packet_count
+                bytes_[idx] = entry.data.byte_count
+            with self._lock:
+                samples = self._samples[name]
+                prev = samples[-1] if samples else None
+            if prev is None:
+                sample = CounterSample(now, None, packets, bytes_,
+                                       None, None, None, None)
+            else:
+                interval = now - prev.time
+                packet_deltas = self._deltas(packets, prev.packets)
+                byte_deltas = self._deltas(bytes_, prev.bytes)
+                sample = CounterSample(
+                    now, interval, packets, bytes_,
+                    packet_deltas, byte_deltas,
+                    array('d', [d / interval for d in packet_deltas]),
+                    array('d', [d / interval for d in byte_deltas]))
+            with self._lock:
+                self._samples[name].append(sample)
+            ret[name] = sample
+        return ret
+
+    @staticmethod
+    def _deltas(values, prev_values):
+        # A direct counter may have more entries than in the previous
+        # sample.  A delta is negative if the counter was reset.
+        n = len(prev_values)
+        deltas = array('q', [v - p for v, p in zip(values, prev_values)])
+        deltas.extend(values[n:].tolist())
+        return deltas
+
+    def _run(self):
+        next_time = time.monotonic()
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logging.error("CounterSampler: reading counters failed: %s",
+                              e)
+                self.error = e
+                return
+            next_time += self.interval
+            if self._stop.wait(max(0, next_time - time.monotonic())):
+                return
+
+    def start(self):
+        assert self._thread is None
+        self._stop.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, raise_errors=True):
+        """Stop the sampling thread, and raise the exception that
+        stopped it, if any, and 'raise_errors' is True.  It is kept in
+        'error' either way."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if raise_errors and self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Do not hide the exception raised in the block.
+        self.stop(raise_errors=(exc_type is None))
+        return False
+
+    def samples(self, name):
+        """Return the list of the CounterSample records kept for
+        counter 'name', oldest first."""
+        with self._lock:
+            return list(self._samples[name])
+
+    def latest(self, name):
+        """Return the last CounterSample of counter 'name', or None."""
+        with self._lock:
+            samples = self._samples[name]
+            return samples[-1] if samples else None
+
+    def keys(self, name):
+        """For a direct counter, return the list of the TableEntry
+        messages, with only the match key and priority set, of the
+        entries whose values are at each index of the samples."""
+        ret = []
+        for key in self._keys[name]:
+            te = p4runtime_pb2.TableEntry()
+            te.ParseFromString(key)
+            ret.append(te)
+        return ret
+
+    def export(self, fname):
+        """Write all kept samples to the file named 'fname', one JSON
+        object per line and per sample, with keys 'counter' and the
+        fields of CounterSample."""
+        def as_list(v):
+            return None if v is None else v.tolist()
+        with open(fname, 'w') as f:
+            for name in self.counters:
+                for sample in self.samples(name):
+                    d = {'counter': name,
+                         'time': sample.time,
+                         'interval': sample.interval}
+                    for field in CounterSample._fields[2:]:
+                        d[field] = as_list(getattr(sample, field))
+                    f.write(json.dumps(d))
+                    f.write("\n")
+
+class P4RuntimeSession(object):
+    """The gRPC channel, P4Runtime stub and StreamChannel used to talk
+    to one device, plus the thread that receives the stream messages
+    from the server and stores them in stream_in_q.
+
+    P4RuntimeTest normally opens a new session in setUp and closes it
+    in tearDown.  With reuse_session enabled, all tests instead share
+    the session returned by get_shared(), which is only re-opened if
+    the server closed the stream.  Each test that attaches to a shared
+    session gets its own stream_in_q, so messages that were not
+    consumed by a previous test are not seen by the next one."""
+
+    # (grpc_addr, device_id) -> session shared by all tests of this
+    # process
+    _pool = {}
+    _pool_lock = threading.Lock()
+
+    # Default timeout of send(), in seconds, while stream_out_q is full
+    send_timeout = 10.0
+
+    def __init__(self, grpc_addr, device_id, shared=False,
+                 stream_out_capacity=0, channel_options=None):
+        self.grpc_addr = grpc_addr
+        self.device_id = device_id
+        self.shared = shared
+        # Set by P4RuntimeTest once the arbitration handshake was done
+        # on this session's stream.
+        self.arbitrated = False
+        if channel_options is None:
+            channel_options = ChannelOptions()
+        self.channel_options = channel_options
+        self.channel = channel_options.open_channel(grpc_addr)
+        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        # With a capacity > 0, send() blocks while the queue is full,
+        # i.e. when messages are produced faster than gRPC sends them.
+        self.stream_out_q = queue.Queue(maxsize=stream_out_capacity)
+        self.stream_in_q = StreamInQueue()
+        # StreamRecorder that keeps the last received messages, if any
+        self.recorder = None
+        # Number of messages put in stream_out_q by send(), and taken
+        # out of it by gRPC to be sent to the server, updated by
+        # several threads with _stats_lock held
+        self.messages_queued = 0
+        self.messages_sent = 0
+        self._stats_lock = threading.Lock()
+
+        def stream_req_iterator():
+            while True:
+                p = self.stream_out_q.get()
+                if p is None:
+                    break
+                with self._stats_lock:
+                    self.messages_sent += 1
+                yield p
+
+        def stream_recv(stream):
+            # Converting a message to text is much more expensive than
+            # receiving it, so do it only if it will be logged.
+            is_enabled_for = logging.getLogger().isEnabledFor
+            try:
+                for p in stream:
+                    msginfo = StreamMessage(time.time(), p)
+                    if is_enabled_for(logging.DEBUG):
+                        logging.debug("stream_recv received at time %s and stored stream msg in stream_in_q: %s",
+                                      msginfo.time, p)
+                    recorder = self.recorder
+                    if recorder is not None:
+                        recorder.record(msginfo)
+                    # Look up stream_in_q for every message, since
+                    # attach() replaces it.
+                    self.stream_in_q.put(msginfo)
+            except grpc.RpcError as e:
+                if self.shared:
+                    logging.warning("P4Runtime stream to %s closed: %s"
+                                    "" % (self.grpc_addr, e))
+                else:
+                    raise
+
+        self.stream = self.stub.StreamChannel(stream_req_iterator())
+        # A shared session lives until the end of the process, so its
+        # thread must not prevent the interpreter from exiting.
+        self.stream_recv_thread = threading.Thread(
+            target=stream_recv, args=(self.stream,), daemon=shared)
+        self.stream_recv_thread.start()
+
+    def is_alive(self):
+        return self.stream_recv_thread.is_alive()
+
+    def send(self, req, timeout=None):
+        """Queue the StreamMessageRequest 'req' to be sent to the server,
+        waiting up to 'timeout' seconds (send_timeout if None) while
+        stream_out_q is full.  Raises queue.Full on timeout."""
+        if timeout is None:
+            timeout = self.send_timeout
+        self.stream_out_q.put(req, timeout=timeout)
+        with self._stats_lock:
+            self.messages_queued += 1
+
+    def stream_out_stats(self):
+        with self._stats_lock:
+            return {'queued': self.messages_queued,
+                    'sent': self.messages_sent,
+                    'pending': self.stream_out_q.qsize()}
+
+    def attach(self, capacity=None, policy='drop-oldest'):
+        """Give the session a new, empty stream_in_q and return it.  See
+        StreamInQueue for the parameters."""
+        old_q = self.stream_in_q
+        self.stream_in_q = StreamInQueue(capacity, policy)
+        # The receiving thread may be blocked in put() on the old queue.
+        old_q.close()
+        return self.stream_in_q
+
+    def close(self):
+        self.stream_in_q.close()
+        # Never block on a full stream_out_q, which nothing empties if
+        # the stream died: make room for the end marker by dropping
+        # messages that were not sent yet.
+        while True:
+            try:
+                self.stream_out_q.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.stream_out_q.get_nowait()
+                except queue.Empty:
+                    pass
+        self.stream_recv_thread.join()
+        self.channel.close()
+
+    @classmethod
+    def get_shared(cls, grpc_addr, device_id, stream_out_capacity=0,
+                   channel_options=None):
+        key = (grpc_addr, device_id)
+        with cls._pool_lock:
+            session = cls._pool.get(key)
+            if session is not None and not session.is_alive():
+                logging.info("Reconnecting P4Runtime session to %s"
+                             "" % (grpc_addr))
+                session.channel.close()
+                session = None
+            if session is None:
+                session = cls(grpc_addr, device_id, shared=True,
+                              stream_out_capacity=stream_out_capacity,
+                              channel_options=channel_options)
+                cls._pool[key] = session
+            return session
+
+    @classmethod
+    def close_all_shared(cls):
+        with cls._pool_lock:
+            sessions = list(cls._pool.values())
+            cls._pool.clear()
+        for session in sessions:
+            if session.is_alive():
+                session.close()
+
+atexit.register(P4RuntimeSession.close_all_shared)
+
 # This code is common to all tests. setUp() is invoked at the beginning of the
 # test and tearDown is called at the end, no matter whether the test passed /
 # failed / errored.
 class P4RuntimeTest(BaseTest):
+    # If True, all tests share one P4RuntimeSession (channel, stream and
+    # arbitration) per device instead of opening a new one in every
+    # setUp.  Can also be enabled with the test parameter
+    # reuse_session=True.
+    reuse_session = False
+
+    # See reset_switch_state().  Installing the pipeline again resets
+    # all of the device state, including entries the test did not
+    # write, e.g. those loaded from a runtime_json file, so it must only
+    # be enabled, here or with the test parameter reset_by_pipeline=True,
+    # for tests that create all of the state of the device.
+    reset_by_pipeline = False
+    reset_threshold = 10000
+
+    # Maximum number of received stream messages of each type kept in
+    # stream_in_q until they are retrieved, and what to do when there
+    # are more (see StreamInQueue).  Can also be set with the test
+    # parameters stream_in_capacity and stream_in_policy.
+    stream_in_capacity = 100000
+    stream_in_policy = 'drop-oldest'
+
+    # Maximum number of messages waiting in stream_out_q to be sent to
+    # the server, 0 for no limit.  If set, send_packet_out and
+    # send_packet_outs block while it is full, for at most
+    # P4RuntimeSession.send_timeout seconds.  Can also be set with the
+    # test parameter stream_out_capacity.
+    stream_out_capacity = 0
+
+    # If > 0, keep that many of the last received stream messages in
+    # a StreamRecorder, see dump_stream_recording().  Can also be set
+    # with the test parameter stream_recorder_size.
+    stream_recorder_size = 0
+
+    # Options of the gRPC channel to the server (see ChannelOptions in
+    # grpc_channel.py): the largest message sent or received, the
+    # largest WriteRequest sent as one RPC, above which _write splits
+    # it, the keepalive ping interval (0 to disable pings), and the
+    # compression algorithm, None for none.  Can also be set with the
+    # test parameters max_message_size, max_request_bytes,
+    # keepalive_time_ms and grpc_compression.
+    max_message_size = DEFAULT_MAX_MESSAGE_SIZE
+    max_request_bytes = DEFAULT_MAX_REQUEST_BYTES
+    keepalive_time_ms = 0
+    grpc_compression = None
+
+    # Measured timings of both reset methods, shared by all tests:
+    # entries deleted per second, and seconds to install the pipeline.
+    _reset_timings = {'delete_rate': None, 'pipeline_seconds': None}
+    # (grpc_addr, device_id, table_name) of the tables for which the
+    # server rejected the single read of table_dump_data, shared by all
+    # tests, so that it is not tried again.
+    _coalesced_read_failed = set()
+
     def setUp(self):
         BaseTest.setUp(self)
         self.device_id = 0
@@ -299,28 +1844,37 @@ class P4RuntimeTest(BaseTest):
         grpc_addr = testutils.test_param_get("grpcaddr")
         if grpc_addr is None:
             grpc_addr = 'localhost:9559'
+        self.grpc_addr = grpc_addr
 
-        self.channel = grpc.insecure_channel(grpc_addr)
-        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        reuse_session = testutils.test_param_get("reuse_session")
+        if isinstance(reuse_session, str):
+            self.reuse_session = reuse_session.lower() in ("1", "true", "yes")
+        elif reuse_session is not None:
+            self.reuse_session = bool(reuse_session)
 
         proto_txt_path = testutils.test_param_get("p4info")
         logging.info("Reading p4info from {}".format(proto_txt_path))
-        self.p4info = p4info_pb2.P4Info()
-        with open(proto_txt_path, "rb") as fin:
-            google.protobuf.text_format.Merge(fin.read(), self.p4info)
+        # Shared with other tests, see p4info_cache.py
+        self.p4info, _ = p4info_cache.load_p4info(proto_txt_path)
 
         self.import_p4info_names()
 
         # used to store write requests sent to the P4Runtime server, useful for
         # autocleanup of tests (see definition of autocleanup decorator below)
-        self._reqs = []
+        self._reqs = WriteJournal()
+        # WriteBatch currently accumulating the updates passed to
+        # write_request, if any (see write_batch below)
+        self._write_batch = None
+        self._counter_samplers = []
 
         self.set_up_stream()
 
-    def updateConfig(self):
+    def updateConfig(self, force=False):
         '''
         Performs a SetForwardingPipelineConfig on the device with provided
-        P4Info and binary device config.
+        P4Info and binary device config.  Unless force is True, this is
+        skipped if the cookie of the pipeline running on the device
+        shows that it is already the same one.
 
         Prerequisite: setUp() method has been called first to create
         the channel.
@@ -328,69 +1882,176 @@ class P4RuntimeTest(BaseTest):
         request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
         request.device_id = self.device_id
         config = request.config
-        # TBD: It seems like there should be a way to do this without
-        # reading the P4info file again, instead getting the data from
-        # self.p4info as saved when executing the setUp() method
-        # above.  The following commented-out assignment does not work.
-        #config.p4info = self.p4info
-        proto_txt_path = testutils.test_param_get("p4info")
-        with open(proto_txt_path, 'r') as fin:
-            google.protobuf.text_format.Merge(fin.read(), config.p4info)
+        # Protobuf message fields cannot be assigned, only copied into.
+        config.p4info.CopyFrom(self.p4info)
         config_path = testutils.test_param_get("config")
         logging.info("Reading config (compiled P4 program) from {}".format(config_path))
         with open(config_path, 'rb') as config_f:
             config.p4_device_config = config_f.read()
+        config.cookie.cookie = pipeline_config_cookie(config.p4info,
+                                                      config.p4_device_config)
+        if not force:
+            device_cookie = get_pipeline_config_cookie(self.stub,
+                                                       self.device_id)
+            if device_cookie == config.cookie.cookie:
+                logging.info("Device already runs this pipeline (cookie 0x%016x), not sending it again"
+                             "" % (device_cookie))
+                return True
         request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
         try:
             response = self.stub.SetForwardingPipelineConfig(request)
         except Exception as e:
-            logging.error("Error during SetForwardingPipelineConfig", file=sys.stderr)
-            logging.error(str(e), file=sys.stderr)
+            logging.error("Error during SetForwardingPipelineConfig")
+            logging.error(str(e))
             return False
         return True
 
+    def reset_switch_state(self, threshold=None):
+        '''
+        Removes the entities stored in the write journal of this test,
+        either by deleting them with undo_write_requests(), or, if
+        reset_by_pipeline is enabled and that is expected to take
+        longer, by installing the pipeline again with updateConfig(),
+        which resets all of the state of the device, including the
+        entries this test did not write.
+
+        Once both methods have been used at least once in this process,
+        the expected duration of each one is computed from their
+        measured timings.  Until then, the pipeline is installed again
+        if the journal has at least 'threshold' entries.  'threshold'
+        defaults to the test parameter reset_threshold, or to the
+        reset_threshold class attribute.  The pipeline is never
+        installed again if reset_by_pipeline is not enabled, or the test
+        parameter 'config' is not set.
+
+        Returns a dict with the strategy used ('none', 'delete' or
+        'pipeline'), the number of journal entries, the elapsed time
+        and the estimates the choice was based on, which is also stored
+        in self.reset_metrics.
+        '''
+        if threshold is None:
+            threshold = testutils.test_param_get("reset_threshold")
+            if threshold is None:
+                threshold = self.reset_threshold
+        threshold = int(threshold)
+        self.flush_write_batch()
+        num_entries = len(self._reqs)
+        timings = P4RuntimeTest._reset_timings
+        est_delete = None
+        est_pipeline = timings['pipeline_seconds']
+        if timings['delete_rate'] is not None:
+            est_delete = num_entries / timings['delete_rate']
+        reset_by_pipeline = testutils.test_param_get("reset_by_pipeline")
+        if reset_by_pipeline is None:
+            reset_by_pipeline = self.reset_by_pipeline
+        elif isinstance(reset_by_pipeline, str):
+            reset_by_pipeline = reset_by_pipeline.lower() in ("1", "true",
+                                                              "yes")
+        can_push = (reset_by_pipeline and
+                    testutils.test_param_get("config") is not None)
+        if num_entries == 0:
+            strategy = 'none'
+        elif not can_push:
+            strategy = 'delete'
+        elif est_delete is not None and est_pipeline is not None:
+            strategy = 'pipeline' if est_pipeline < est_delete else 'delete'
+        else:
+            strategy = 'pipeline' if num_entries >= threshold else 'delete'
+
+        start = time.time()
+        if strategy == 'pipeline':
+            if self.updateConfig(force=True):
+                self._reqs.clear()
+            else:
+                logging.warning("reset_switch_state: installing the pipeline failed, deleting entries instead")
+                strategy = 'delete'
+                start = time.time()
+        if strategy == 'delete':
+            self.undo_write_requests(self._reqs)
+        elapsed = time.time() - start
+
+        # Exponentially weighted averages with a weight of 1/2 for the
+        # new measurement, so that they follow changes in the
+        # performance of the device.
+        if strategy == 'pipeline':
+            timings['pipeline_seconds'] = elapsed if est_pipeline is None \
+                else (est_pipeline + elapsed) / 2
+        elif strategy == 'delete' and num_entries >= 100 and elapsed > 0:
+            rate = num_entries / elapsed
+            timings['delete_rate'] = rate if timings['delete_rate'] is None \
+                else (timings['delete_rate'] + rate) / 2
+        self.reset_metrics = {'strategy': strategy,
+                              'entries': num_entries,
+                              'seconds': elapsed,
+                              'estimated_delete_seconds': est_delete,
+                              'estimated_pipeline_seconds': est_pipeline,
+                              'threshold': threshold}
+        logging.info("reset_switch_state: %s" % (self.reset_metrics))
+        return self.reset_metrics
+
     # In order to make writing tests easier, we accept any suffix that uniquely
     # identifies the object among p4info objects of the same type.
     def import_p4info_names(self):
-        self.p4info_obj_map = {}
-        suffix_count = Counter()
-        for obj_type in ["tables", "action_profiles", "actions", "counters",
-                         "direct_counters", "controller_packet_metadata"]:
-            for obj in getattr(self.p4info, obj_type):
-                pre = obj.preamble
-                suffix = None
-                for s in reversed(pre.name.split(".")):
-                    suffix = s if suffix is None else s + "." + suffix
-                    key = (obj_type, suffix)
-                    self.p4info_obj_map[key] = obj
-                    suffix_count[key] += 1
-        for key, c in list(suffix_count.items()):
-            if c > 1:
-                del self.p4info_obj_map[key]
+        self.p4info_obj_map = p4info_cache.make_obj_map(self.p4info)
+        self.p4info_index = P4InfoIndex(self.p4info)
+
+    def get_channel_options(self):
+        """Return the ChannelOptions of the channel to the server, from
+        the test parameters, or the class attributes for those that are
+        not set."""
+        params = {}
+        for name in ('max_message_size', 'max_request_bytes',
+                     'keepalive_time_ms'):
+            v = testutils.test_param_get(name)
+            params[name] = int(v if v is not None else getattr(self, name))
+        compression = testutils.test_param_get("grpc_compression")
+        if compression is None:
+            compression = self.grpc_compression
+        return ChannelOptions(compression=compression, **params)
 
     def set_up_stream(self):
-        self.stream_out_q = queue.Queue()
-        self.stream_in_q = queue.Queue()
-        def stream_req_iterator():
-            while True:
-                p = self.stream_out_q.get()
-                if p is None:
-                    break
-                yield p
-
-        def stream_recv(stream):
-            for p in stream:
-                now = time.time()
-                logging.debug("stream_recv received at time %s and stored stream msg in stream_in_q: %s"
-                              "" % (now, p))
-                self.stream_in_q.put({'time': now, 'message': p})
-
-        self.stream = self.stub.StreamChannel(stream_req_iterator())
-        self.stream_recv_thread = threading.Thread(
-            target=stream_recv, args=(self.stream,))
-        self.stream_recv_thread.start()
+        stream_out_capacity = testutils.test_param_get("stream_out_capacity")
+        if stream_out_capacity is None:
+            stream_out_capacity = self.stream_out_capacity
+        stream_out_capacity = int(stream_out_capacity)
+        channel_options = self.get_channel_options()
+        if self.reuse_session:
+            self.session = P4RuntimeSession.get_shared(
+                self.grpc_addr, self.device_id, stream_out_capacity,
+                channel_options)
+        else:
+            self.session = P4RuntimeSession(
+                self.grpc_addr, self.device_id,
+                stream_out_capacity=stream_out_capacity,
+                channel_options=channel_options)
+        # A shared session keeps the options it was opened with.
+        self.channel_options = self.session.channel_options
+        self.channel = self.session.channel
+        self.stub = self.session.stub
+        self.stream = self.session.stream
+        self.stream_recv_thread = self.session.stream_recv_thread
+        self.stream_out_q = self.session.stream_out_q
+        capacity = testutils.test_param_get("stream_in_capacity")
+        if capacity is None:
+            capacity = self.stream_in_capacity
+        policy = testutils.test_param_get("stream_in_policy")
+        if policy is None:
+            policy = self.stream_in_policy
+        if capacity is not None and not isinstance(capacity, dict):
+            capacity = int(capacity)
+        self.stream_in_q = self.session.attach(capacity, policy)
+        recorder_size = testutils.test_param_get("stream_recorder_size")
+        if recorder_size is None:
+            recorder_size = self.stream_recorder_size
+        recorder_size = int(recorder_size)
+        if recorder_size > 0:
+            self.session.recorder = StreamRecorder(recorder_size)
+        else:
+            self.session.recorder = None
 
-        self.handshake()
+        if not self.session.arbitrated:
+            self.handshake()
+            self.session.arbitrated = True
 
     def handshake(self):
         req = p4runtime_pb2.StreamMessageRequest()
@@ -402,7 +2063,7 @@ class P4RuntimeTest(BaseTest):
         # election_id = arbitration.election_id
         # election_id.high = 0
         # election_id.low = 1
-        self.stream_out_q.put(req)
+        self.session.send(req)
 
         logging.debug("handshake() checking whether arbitration msg received from server")
         rep = self.get_stream_packet("arbitration", timeout=2)
@@ -410,12 +2071,31 @@ class P4RuntimeTest(BaseTest):
             self.fail("Failed to establish handshake")
 
     def tearDown(self):
-        self.tear_down_stream()
-        BaseTest.tearDown(self)
+        try:
+            for sampler in self._counter_samplers:
+                sampler.stop(raise_errors=False)
+                if sampler.error is not None:
+                    logging.error("CounterSampler stopped by an error:"
+                                  " %s" % (sampler.error))
+        finally:
+            self.tear_down_stream()
+            BaseTest.tearDown(self)
 
     def tear_down_stream(self):
-        self.stream_out_q.put(None)
-        self.stream_recv_thread.join()
+        if self.session.shared:
+            # Messages received from now on are not seen by any test.
+            self.session.attach()
+        else:
+            self.session.close()
+
+    def dump_stream_recording(self, fname=None):
+        """Write out the messages kept by the StreamRecorder of this
+        test's session, if stream_recorder_size > 0.  See
+        StreamRecorder.dump()."""
+        if self.session.recorder is None:
+            logging.info("No stream messages recorded, stream_recorder_size is 0")
+            return
+        self.session.recorder.dump(fname)
 
     def get_packet_in(self, timeout=1):
         msg = self.get_stream_packet("packet", timeout)
@@ -441,23 +2121,18 @@ class P4RuntimeTest(BaseTest):
                       "" % (name, name_to_int, int_to_name))
         return name_to_int, int_to_name
 
-    def controller_packet_metadata_dict_key_id(self, name):
+    def get_packet_metadata_info(self, name):
         cpm_info = self.get_controller_packet_metadata(name)
         assert cpm_info != None
-        ret = {}
-        for md in cpm_info.metadata:
-            id = md.id
-            ret[md.id] = {'id': md.id, 'name': md.name, 'bitwidth': md.bitwidth}
-        return ret
+        return self.p4info_index.packet_metadata[cpm_info.preamble.id]
+
+    # The dicts returned by the two methods below are shared, and must
+    # not be modified by the caller.
+    def controller_packet_metadata_dict_key_id(self, name):
+        return self.get_packet_metadata_info(name).by_id
 
     def controller_packet_metadata_dict_key_name(self, name):
-        cpm_info = self.get_controller_packet_metadata(name)
-        assert cpm_info != None
-        ret = {}
-        for md in cpm_info.metadata:
-            id = md.id
-            ret[md.name] = {'id': md.id, 'name': md.name, 'bitwidth': md.bitwidth}
-        return ret
+        return self.get_packet_metadata_info(name).by_name
 
     def decode_packet_in_metadata(self, packet):
         pktin_info = self.controller_packet_metadata_dict_key_id("packet_in")
@@ -470,7 +2145,25 @@ class P4RuntimeTest(BaseTest):
             pktin_field_to_val[md_field_info['name']] = md_val_int
         ret = {'metadata': pktin_field_to_val,
                'payload': packet.payload}
-        logging.debug("decode_packet_in_metadata: ret=%s" % (ret))
+        logging.debug("decode_packet_in_metadata: ret=%s", ret)
+        return ret
+
+    def make_packet_in_decoder(self):
+        """Return a PacketInDecoder for the packet_in header."""
+        return PacketInDecoder(self.get_packet_metadata_info("packet_in"))
+
+    def get_packet_ins(self, max_count=None, timeout=0):
+        """Remove and return the PacketIn messages received so far, up
+        to 'max_count' of them, waiting up to 'timeout' seconds for the
+        first one.  Use with PacketInDecoder.decode_batch() to analyze
+        many PacketIns at once."""
+        ret = []
+        while max_count is None or len(ret) < max_count:
+            msginfo = self.stream_in_q.get("packet",
+                                           timeout if len(ret) == 0 else 0)
+            if msginfo is None:
+                break
+            ret.append(msginfo.message.packet)
         return ret
 
     def verify_packet_in(self, exp_pktinfo, received_pktinfo):
@@ -484,58 +2177,35 @@ class P4RuntimeTest(BaseTest):
     def get_stream_packet(self, type_, timeout=1):
         """Get and return the next stream_in packet that has type
         equal to type_.  If type_ is None, then get the next stream_in
-        packet regardless of its type.  If type_ is not None, this
-        method reads and discards any messages it finds with a
-        different type.  If no appropriate message to be returned is
-        found within the 'timeout' value (in seconds), return None."""
-        start = time.time()
-        try:
-            while True:
-                remaining = timeout - (time.time() - start)
-                if remaining < 0:
-                    break
-                msg = self.stream_in_q.get(timeout=remaining)
-                logging.debug("get_stream_packet dequeuing msg from stream_in_q: %s"
-                              "" % (msg))
-                if type_ is None or msg['message'].HasField(type_):
-                    return msg['message']
-                logging.debug("get_stream_packet msg=%s has no field type_=%s so discarding"
-                              "" % (msg, type_))
-        except:  # timeout expired
-            pass
-        return None
+        packet regardless of its type.  Messages of other types are
+        left in stream_in_q, for later calls asking for their type.
+        If no appropriate message to be returned is found within the
+        'timeout' value (in seconds), return None."""
+        msginfo = self.stream_in_q.get(type_, timeout)
+        if msginfo is None:
+            return None
+        logging.debug("get_stream_packet dequeuing msg from stream_in_q: %s",
+                      msginfo)
+        return msginfo.message
 
     def get_stream_packet2(self, type_, timeout=1):
         """Like get_stream_packet, except it returns two values.  The first is
-        a dictionary with the key 'message' having a value that is the
-        message, and a key 'time' having the value of time.time() when
+        a StreamMessage with the attribute (or key) 'message' having a value
+        that is the message, and 'time' having the value of time.time() when
         that message was received and stored in an internal queue
         where it waits to be retrieved by get_stream_packet or this
-        method.  The second return value is a list of dictionaries,
-        each with the same keys, containing all of the received
-        messages that were skipped over in order to get t othe message
-        with the desired type_ value.  As for get_stream_packet, the
-        first return value is None if no stream_in message is
-        retrieved within the specified timeout."""
-        start = time.time()
-        skipped_msginfos = []
-        try:
-            while True:
-                remaining = timeout - (time.time() - start)
-                if remaining < 0:
-                    return None, skipped_msginfos
-                    break
-                msginfo = self.stream_in_q.get(timeout=remaining)
-                logging.debug("get_stream_packet dequeuing msginfo from stream_in_q: %s"
-                              "" % (msginfo))
-                if type_ is None or msg['message'].HasField(type_):
-                    return msginfo, skipped_msginfos
-                logging.debug("get_stream_packet msginfo['message'] has no field type_=%s so discarding"
-                              "" % (type_))
-                skipped_msginfos.append(msginfo)
-        except:  # timeout expired
-            pass
-        return None
+        method.  The second return value is a list of the received
+        messages that were skipped over in order to get to the message
+        with the desired type_ value.  Since stream_in_q keeps messages
+        of different types separately, no message is ever skipped, and
+        it is always empty.  As for get_stream_packet, the first return
+        value is None if no stream_in message is retrieved within the
+        specified timeout."""
+        msginfo = self.stream_in_q.get(type_, timeout)
+        if msginfo is not None:
+            logging.debug("get_stream_packet2 dequeuing msginfo from stream_in_q: %s",
+                          msginfo)
+        return msginfo, []
 
     def encode_packet_out_metadata(self, pktout_dict):
         ret = p4runtime_pb2.PacketOut()
@@ -559,7 +2229,57 @@ class P4RuntimeTest(BaseTest):
     def send_packet_out(self, packet):
         packet_out_req = p4runtime_pb2.StreamMessageRequest()
         packet_out_req.packet.CopyFrom(packet)
-        self.stream_out_q.put(packet_out_req)
+        self.session.send(packet_out_req)
+
+    def make_packet_out_encoder(self, field_names=None):
+        """Return a PacketOutEncoder for the packet_out header, with the
+        metadata fields in 'field_names', in that order, or all of them
+        in P4Info order if 'field_names' is None."""
+        return PacketOutEncoder(self.get_packet_metadata_info("packet_out"),
+                                field_names)
+
+    def send_packet_outs(self, packets, encoder=None, timeout=None):
+        """Send one PacketOut for each (payload, metadata_values) tuple
+        in the iterable 'packets', with metadata_values being a sequence
+        of values in the order of the fields of 'encoder' (a
+        PacketOutEncoder, by default one with all fields of packet_out).
+        Blocks while stream_out_q is full, for at most 'timeout' seconds
+        per packet, or P4RuntimeSession.send_timeout if None, and raises
+        queue.Full on timeout (see P4RuntimeSession.send).  Returns the
+        number of packets queued."""
+        if encoder is None:
+            encoder = self.make_packet_out_encoder()
+        encode = encoder.encode
+        send = self.session.send
+        n = 0
+        for payload, values in packets:
+            send(encode(payload, values), timeout)
+            n += 1
+        return n
+
+    def packet_out_stats(self):
+        """Return a dict with the number of stream messages, mostly
+        PacketOuts, 'queued' and 'sent' so far on this test's session,
+        and the number 'pending' in stream_out_q."""
+        return self.session.stream_out_stats()
+
+    def counter_sampler(self, counters, interval=1.0, history=60):
+        """Return a CounterSampler reading 'counters' every 'interval'
+        seconds once started.  It is stopped in tearDown, if the test
+        did not stop it."""
+        sampler = CounterSampler(self, counters, interval, history)
+        self._counter_samplers.append(sampler)
+        return sampler
+
+    def digest_consumer(self, ack_batch=64):
+        """Return a DigestConsumer, to receive, decode and acknowledge
+        the digests configured with send_request_add_digest."""
+        return DigestConsumer(self, ack_batch)
+
+    def latency_probe(self, key=None, tag=True):
+        """Return a PacketLatencyProbe, to measure the round trip
+        latency of PacketOuts that come back as PacketIns."""
+        return PacketLatencyProbe(self, key, tag)
 
     def swports(self, idx):
         if idx >= len(self._swports):
@@ -581,17 +2301,17 @@ class P4RuntimeTest(BaseTest):
         a = self.get_obj("actions", action_name)
         if a is None:
             return None
-        for p in a.params:
-            if p.name == name:
-                return p.id
+        p = self.p4info_index.actions[a.preamble.id].params.get(name)
+        if p is None:
+            return None
+        return p.id
 
     def get_mf_by_name(self, table_name, field_name):
         t = self.get_obj("tables", table_name)
         if t is None:
             return None
-        for mf in t.match_fields:
-            if mf.name == field_name:
-                return mf
+        return self.p4info_index.tables[t.preamble.id].match_fields.get(
+            field_name)
 
     # These are attempts at convenience functions aimed at making writing
     # P4Runtime PTF tests easier.
@@ -694,18 +2414,21 @@ class P4RuntimeTest(BaseTest):
     # object of MF instances
     def set_match_key(self, table_entry, t_name, mk):
         table_obj = self.get_obj("tables", t_name)
+        match_fields = self.p4info_index.tables[
+            table_obj.preamble.id].match_fields
         for mf in mk:
-            mf_obj = self.get_mf_by_name(t_name, mf.name)
+            mf_obj = match_fields[mf.name]
             mf.add_to(mf_obj.id, mf_obj.bitwidth, table_entry.match)
 
     def set_action(self, action, a_name, params):
         action_id = self.get_action_id(a_name)
         if action_id is None:
-            self.fail("Failed to get id of action '{}' - perhaps the action name is misspelled?").format(a_name)
+            self.fail("Failed to get id of action '{}' - perhaps the action name is misspelled?".format(a_name))
         action.action_id = action_id
+        action_params = self.p4info_index.actions[action_id].params
         for p_name, v in params:
             param = action.params.add()
-            param.param_id = self.get_param_id(a_name, p_name)
+            param.param_id = action_params[p_name].id
             param.value = stringify(v)
 
     # Sets the action & action data for a p4::TableEntry object. params needs to
@@ -714,19 +2437,43 @@ class P4RuntimeTest(BaseTest):
         self.set_action(table_entry.action.action, a_name, params)
 
     def _write(self, req):
-        try:
-            return self.stub.Write(req)
-        except grpc.RpcError as e:
-            if e.code() != grpc.StatusCode.UNKNOWN:
-                raise e
-            raise P4RuntimeWriteException(e)
+        return write_split(self.stub, req,
+                           self.channel_options.max_request_bytes)
 
     def write_request(self, req, store=True):
-        rep = self._write(req)
+        if self._write_batch is not None:
+            self._write_batch.add(req, store)
+            return None
+        try:
+            rep = self._write(req)
+        except grpc.RpcError as e:
+            if store:
+                for idx in written_update_indices(e):
+                    self._reqs.record_update(req.updates[idx])
+            raise
         if store:
             self._reqs.append(req)
         return rep
 
+    def write_batch(self, max_updates=1000, max_delay=0.5,
+                    raise_errors=True):
+        """Return a WriteBatch context manager.  All write requests
+        made through write_request while it is active are combined
+        into WriteRequest messages of at most 'max_updates' updates.
+        See class WriteBatch for details."""
+        return WriteBatch(self, max_updates, max_delay, raise_errors)
+
+    def flush_write_batch(self):
+        if self._write_batch is not None:
+            self._write_batch.flush()
+
+    def pipeline(self, window=16):
+        """Return a P4RuntimePipeline context manager, which keeps up
+        to 'window' Write and Read RPCs in flight.  See class
+        P4RuntimePipeline for details."""
+        self.flush_write_batch()
+        return P4RuntimePipeline(self, window)
+
     #
     # Convenience functions to build and send P4Runtime write requests
     #
@@ -795,6 +2542,53 @@ class P4RuntimeTest(BaseTest):
         self.push_update_set_group_membership(req, ap_name, grp_id, mbr_ids)
         return req, self.write_request(req, store=False)
 
+    def _push_update_digest(self, req, digest_name, max_list_size,
+                            max_timeout_ns, ack_timeout_ns, update_type):
+        update = req.updates.add()
+        update.type = update_type
+        digest_entry = update.entity.digest_entry
+        digest_entry.digest_id = self.get_digest_id(digest_name)
+        digest_entry.config.max_list_size = max_list_size
+        digest_entry.config.max_timeout_ns = max_timeout_ns
+        digest_entry.config.ack_timeout_ns = ack_timeout_ns
+
+    # The switch sends a DigestList when it has 'max_list_size' digests
+    # to send, or 'max_timeout_ns' after the first digest of the list
+    # was generated, whichever comes first, and does not send the same
+    # digest data again until the list is acknowledged, or until
+    # 'ack_timeout_ns' passed.
+    def push_update_add_digest(self, req, digest_name, max_list_size=1,
+                               max_timeout_ns=0,
+                               ack_timeout_ns=1000000000):
+        self._push_update_digest(req, digest_name, max_list_size,
+                                 max_timeout_ns, ack_timeout_ns,
+                                 p4runtime_pb2.Update.INSERT)
+
+    def send_request_add_digest(self, digest_name, max_list_size=1,
+                                max_timeout_ns=0,
+                                ack_timeout_ns=1000000000):
+        req = p4runtime_pb2.WriteRequest()
+        req.device_id = self.device_id
+        self.push_update_add_digest(req, digest_name, max_list_size,
+                                    max_timeout_ns, ack_timeout_ns)
+        return req, self.write_request(req)
+
+    def push_update_modify_digest(self, req, digest_name, max_list_size=1,
+                                  max_timeout_ns=0,
+                                  ack_timeout_ns=1000000000):
+        self._push_update_digest(req, digest_name, max_list_size,
+                                 max_timeout_ns, ack_timeout_ns,
+                                 p4runtime_pb2.Update.MODIFY)
+
+    def send_request_modify_digest(self, digest_name, max_list_size=1,
+                                   max_timeout_ns=0,
+                                   ack_timeout_ns=1000000000):
+        req = p4runtime_pb2.WriteRequest()
+        req.device_id = self.device_id
+        self.push_update_modify_digest(req, digest_name, max_list_size,
+                                       max_timeout_ns, ack_timeout_ns)
+        return req, self.write_request(req, store=False)
+
     #
     # for all add_entry function, use mk == None for default entry
     #
@@ -862,6 +2656,50 @@ class P4RuntimeTest(BaseTest):
         self.set_action_entry(table_entry, action_name, action_params)
         return table_entry
 
+    def compile_table_entry(self, table_name, field_names, action_name,
+                            param_names, priority=False):
+        """Return a TableEntryBuilder for entries of table
+        'table_name' that match on the fields in 'field_names', in
+        that order, and use action 'action_name' with the parameters
+        in 'param_names', in that order."""
+        table_obj = self.get_obj("tables", table_name)
+        if table_obj is None:
+            self.fail("Unknown table '{}'".format(table_name))
+        table_info = self.p4info_index.tables[table_obj.preamble.id]
+        match_fields = []
+        for field_name in field_names:
+            mf = table_info.match_fields.get(field_name)
+            if mf is None:
+                self.fail("Table '{}' has no match field '{}'".format(
+                    table_name, field_name))
+            match_fields.append((mf.id, mf.bitwidth, mf.match_type))
+        action_id = self.get_action_id(action_name)
+        if action_id is None:
+            self.fail("Failed to get id of action '{}' - perhaps the action name is misspelled?".format(action_name))
+        action_params = self.p4info_index.actions[action_id].params
+        param_ids = []
+        for param_name in param_names:
+            p = action_params.get(param_name)
+            if p is None:
+                self.fail("Action '{}' has no parameter '{}'".format(
+                    action_name, param_name))
+            param_ids.append(p.id)
+        return TableEntryBuilder(table_obj.preamble.id, match_fields,
+                                 action_id, param_ids, priority)
+
+    def table_add_rows(self, builder, rows):
+        """Insert one table entry per row of 'rows', built with the
+        TableEntryBuilder 'builder', through the active WriteBatch if
+        there is one, or else through a new one."""
+        batch = self._write_batch
+        if batch is not None:
+            for row in rows:
+                batch.emit(builder, row)
+            return
+        with self.write_batch() as batch:
+            for row in rows:
+                batch.emit(builder, row)
+
     # A shorter name for send_request_add_entry_to_action, and also
     # bundles up table name and key into one tuple, and action name
     # and params into another tuple, for the convenience of the caller
@@ -927,6 +2765,9 @@ class P4RuntimeTest(BaseTest):
         return req, self.write_request(req, store=False)
 
     def response_dump_helper(self, request):
+        # Make sure that reads observe the writes still pending in a
+        # batch.
+        self.flush_write_batch()
         for response in self.stub.Read(request):
             yield response
 
@@ -943,22 +2784,43 @@ class P4RuntimeTest(BaseTest):
             counter.counter_id = self.get_counter_id(counter_name)
         return req, counter
 
-    def counter_dump_data(self, counter_name, direct=False):
-        req, counter = self.make_counter_read_request(counter_name, direct)
+    def _entries_iter(self, req, exp_one_of, filter_fn, project_fn):
+        for response in self.response_dump_helper(req):
+            for entity in response.entities:
+                assert entity.WhichOneof('entity') == exp_one_of
+                entry = getattr(entity, exp_one_of)
+                if filter_fn is not None and not filter_fn(entry):
+                    continue
+                if project_fn is not None:
+                    entry = project_fn(entry)
+                yield entry
+
+    def counter_entries_iter(self, counter_name, direct=False,
+                             filter_fn=None, project_fn=None):
+        """Generator yielding the CounterEntry (DirectCounterEntry if
+        'direct' is True) messages of counter 'counter_name', as the
+        ReadResponse messages containing them arrive, without keeping
+        them in memory.  Only the entries for which filter_fn(entry) is
+        true are yielded, if 'filter_fn' is not None, and each one is
+        replaced by project_fn(entry) if 'project_fn' is not None."""
+        req, _ = self.make_counter_read_request(counter_name, direct)
         if direct:
             exp_one_of = 'direct_counter_entry'
         else:
             exp_one_of = 'counter_entry'
-        counter_entries = []
-        for response in self.response_dump_helper(req):
-            for entity in response.entities:
-                assert entity.WhichOneof('entity') == exp_one_of
-                if direct:
-                    entry = entity.direct_counter_entry
-                else:
-                    entry = entity.counter_entry
-                counter_entries.append(entry)
-        return counter_entries
+        return self._entries_iter(req, exp_one_of, filter_fn, project_fn)
+
+    def counter_dump_data(self, counter_name, direct=False):
+        return list(self.counter_entries_iter(counter_name, direct))
+
+    def dump_counter_to_file(self, counter_name, fname, direct=False,
+                             fmt=None, filter_fn=None, project_fn=None):
+        """Write the entries of counter_entries_iter() to the file named
+        'fname', as they arrive, see entity_dump.dump_entries().
+        Returns the number of entries written."""
+        return entity_dump.dump_entries(
+            self.counter_entries_iter(counter_name, direct, filter_fn,
+                                      project_fn), fname, fmt)
 
     def make_table_read_request(self, table_name):
         req = p4runtime_pb2.ReadRequest()
@@ -968,18 +2830,87 @@ class P4RuntimeTest(BaseTest):
         table.table_id = self.get_table_id(table_name)
         return req, table
 
+    def table_entries_iter(self, table_name, filter_fn=None,
+                           project_fn=None):
+        """Generator yielding the TableEntry messages of the normal
+        entries of table 'table_name', with the same streaming,
+        filtering and projection as counter_entries_iter()."""
+        req, _ = self.make_table_read_request(table_name)
+        return self._entries_iter(req, 'table_entry', filter_fn, project_fn)
+
+    def dump_table_to_file(self, table_name, fname, fmt=None,
+                           filter_fn=None, project_fn=None):
+        """Write the entries of table_entries_iter() to the file named
+        'fname', as they arrive, see entity_dump.dump_entries().
+        Returns the number of entries written."""
+        return entity_dump.dump_entries(
+            self.table_entries_iter(table_name, filter_fn, project_fn),
+            fname, fmt)
+
+    def sync_table(self, table_name, desired_entries, delete_extra=True,
+                   max_updates=1000):
+        """Make the normal entries of table 'table_name' equal to the
+        TableEntry messages of 'desired_entries', e.g. built with
+        make_table_entry, with as few updates as possible: entries
+        missing from the switch are inserted, entries with the same
+        match key and priority but different contents are modified, and
+        entries on the switch that are not desired are deleted, unless
+        'delete_extra' is False.  Updates are sent in WriteRequests of
+        at most 'max_updates' updates, deletions first.  Returns a dict
+        with the number of updates of each type, and of entries that
+        were already as desired."""
+        diff = table_sync.diff_table_entries(
+            desired_entries, self.table_entries_iter(table_name),
+            delete_extra)
+        with self.write_batch(max_updates) as batch:
+            for update_type, entries, store in [
+                    (p4runtime_pb2.Update.DELETE, diff.deletes, True),
+                    (p4runtime_pb2.Update.MODIFY, diff.modifies, False),
+                    (p4runtime_pb2.Update.INSERT, diff.inserts, True)]:
+                for i in range(0, len(entries), max_updates):
+                    req = p4runtime_pb2.WriteRequest()
+                    req.device_id = self.device_id
+                    for entry in entries[i:i + max_updates]:
+                        update = req.updates.add()
+                        update.type = update_type
+                        update.entity.table_entry.CopyFrom(entry)
+                    batch.add(req, store)
+                # The updates of a WriteRequest may be applied in any
+                # order, so make sure that deleted entries free their
+                # space in the table before inserting new ones.
+                batch.flush()
+        return {'insert': len(diff.inserts), 'modify': len(diff.modifies),
+                'delete': len(diff.deletes), 'unchanged': diff.unchanged}
+
     def table_dump_data(self, table_name):
-        req, table = self.make_table_read_request(table_name)
-        table_entries = []
-        for response in self.response_dump_helper(req):
-            for entity in response.entities:
-                #print('entity.WhichOneof("entity")="%s"'
-                #      '' % (entity.WhichOneof('entity')))
-                assert entity.WhichOneof('entity') == 'table_entry'
-                entry = entity.table_entry
-                table_entries.append(entry)
-                #print(entry)
-                #print('----')
+        # Read the normal entries and the default entry with a single
+        # RPC.  Targets that do not support reading the default entry
+        # may reject the whole request, in which case the normal
+        # entries and the default entry are read separately below.
+        coalesced_key = (self.grpc_addr, self.device_id, table_name)
+        if coalesced_key not in P4RuntimeTest._coalesced_read_failed:
+            req, table = self.make_table_read_request(table_name)
+            entity = req.entities.add()
+            entity.CopyFrom(req.entities[0])
+            entity.table_entry.is_default_action = True
+            try:
+                table_entries = []
+                table_default_entry = None
+                for response in self.response_dump_helper(req):
+                    for entity in response.entities:
+                        assert entity.WhichOneof('entity') == 'table_entry'
+                        if entity.table_entry.is_default_action:
+                            table_default_entry = entity
+                        else:
+                            table_entries.append(entity.table_entry)
+                return table_entries, table_default_entry
+            except grpc.RpcError as e:
+                P4RuntimeTest._coalesced_read_failed.add(coalesced_key)
+                logging.debug("table_dump_data: coalesced read of table %s"
+                              " failed, reading the default entry"
+                              " separately from now on: %s", table_name, e)
+
+        table_entries = list(self.table_entries_iter(table_name))
 
         # Now try to get the default action.  I say 'try' because as
         # of 2019-Mar-21, this is not yet implemented in the open
@@ -995,14 +2926,184 @@ class P4RuntimeTest(BaseTest):
                     #print('entity.WhichOneof("entity")="%s"'
                     #      '' % (entity.WhichOneof('entity')))
                     assert entity.WhichOneof('entity') == 'table_entry'
-                    entry = entity.table_entry
                     table_default_entry = entity
-        except grpc._channel._Rendezvous as e:
+        except grpc.RpcError as e:
             print("Caught exception:")
             print(e)
 
         return table_entries, table_default_entry
 
+    def parallel_table_dump(self, table_names, window=16):
+        """Read all normal entries of the tables in 'table_names'
+        with concurrent Read RPCs, and return a dict mapping each table
+        name to its list of TableEntry messages."""
+        futs = {}
+        with self.pipeline(window) as pl:
+            for table_name in table_names:
+                req, _ = self.make_table_read_request(table_name)
+                futs[table_name] = pl.read(req)
+        ret = {}
+        for table_name, fut in futs.items():
+            ret[table_name] = [entity.table_entry
+                               for response in fut.result()
+                               for entity in response.entities]
+        return ret
+
+    # The kinds of objects accepted by read_entities, and the Entity
+    # field used to read all entries of each.
+    READ_KINDS = {'table': 'table_entry',
+                  'table_default': 'table_entry',
+                  'counter': 'counter_entry',
+                  'direct_counter': 'direct_counter_entry',
+                  'register': 'register_entry',
+                  'meter': 'meter_entry',
+                  'direct_meter': 'direct_meter_entry'}
+
+    def _add_read_entity(self, req, kind, name):
+        # Add to ReadRequest 'req' an entity reading all entries of the
+        # object, and return the key that _read_entity_key returns for
+        # the entities of the responses.
+        if kind not in self.READ_KINDS:
+            raise ValueError("Cannot read objects of kind '%s'" % (kind))
+        if kind in ('direct_counter', 'direct_meter'):
+            obj = self.get_obj(kind + "s", name)
+            obj_id = None if obj is None else obj.direct_table_id
+        else:
+            obj_id = self.get_obj_id({'table_default': 'tables'}.get(
+                kind, kind + "s"), name)
+        if obj_id is None:
+            raise ValueError("Unknown %s '%s'" % (kind, name))
+        entity = req.entities.add()
+        one_of = self.READ_KINDS[kind]
+        entry = getattr(entity, one_of)
+        if kind == 'table' or kind == 'table_default':
+            entry.table_id = obj_id
+            entry.is_default_action = (kind == 'table_default')
+        elif kind == 'counter':
+            entry.counter_id = obj_id
+        elif kind == 'register':
+            entry.register_id = obj_id
+        elif kind == 'meter':
+            entry.meter_id = obj_id
+        else:
+            entry.table_entry.table_id = obj_id
+        return one_of, obj_id, kind == 'table_default'
+
+    @staticmethod
+    def _read_entity_key(entity):
+        one_of = entity.WhichOneof('entity')
+        entry = getattr(entity, one_of)
+        if one_of == 'table_entry':
+            return one_of, entry.table_id, entry.is_default_action
+        if one_of == 'counter_entry':
+            return one_of, entry.counter_id, False
+        if one_of == 'register_entry':
+            return one_of, entry.register_id, False
+        if one_of == 'meter_entry':
+            return one_of, entry.meter_id, False
+        # direct_counter_entry, direct_meter_entry
+        return one_of, entry.table_entry.table_id, False
+
+    def read_entities(self, objects, max_entities_per_request=64, window=1):
+        """Read all entries of every object in 'objects', a sequence of
+        (kind, name) tuples, where kind is one of the keys of
+        READ_KINDS, e.g. [('table', 'ipv4_lpm'), ('table_default',
+        'ipv4_lpm'), ('counter', 'ingressPktStats')].
+
+        The objects are read with as few ReadRequests as possible, each
+        with at most 'max_entities_per_request' entities, with up to
+        'window' of them in flight at once.  Returns a dict mapping each
+        (kind, name) tuple to the list of entries read for it, i.e. of
+        TableEntry, CounterEntry, DirectCounterEntry, RegisterEntry,
+        MeterEntry or DirectMeterEntry messages."""
+        reqs, owners = self.make_read_entities_requests(
+            objects, max_entities_per_request)
+        ret = {owner: [] for owner in owners.values()}
+        if window <= 1:
+            for req in reqs:
+                self.demux_read_responses(self._read_split(req), owners,
+                                          ret)
+        else:
+            pl = self.pipeline(window)
+            try:
+                futs = [(req, pl.read(req)) for req in reqs]
+                pl.drain(raise_errors=False)
+            finally:
+                pl.close()
+            for req, fut in futs:
+                exc = fut.exception()
+                if exc is None:
+                    responses = fut.result()
+                elif self._is_too_large(exc) and len(req.entities) > 1:
+                    responses = self._read_split(req)
+                else:
+                    raise exc
+                self.demux_read_responses(responses, owners, ret)
+        return ret
+
+    @staticmethod
+    def _is_too_large(exc):
+        return (isinstance(exc, grpc.RpcError) and
+                exc.code() == grpc.StatusCode.RESOURCE_EXHAUSTED)
+
+    def _read_split(self, req):
+        """Generator yielding the ReadResponses of 'req'.  If a response
+        is larger than the channel accepts, 'req' is read again as two
+        requests with half of its entities each, recursively.  Responses
+        are only yielded once the whole request was read."""
+        try:
+            responses = list(self.response_dump_helper(req))
+        except grpc.RpcError as e:
+            if not self._is_too_large(e) or len(req.entities) <= 1:
+                raise
+            half = len(req.entities) // 2
+            logging.debug("Read response too large, splitting ReadRequest"
+                          " of %d entities: %s" % (len(req.entities), e))
+            for entities in (req.entities[:half], req.entities[half:]):
+                sub_req = p4runtime_pb2.ReadRequest()
+                sub_req.device_id = req.device_id
+                sub_req.entities.extend(entities)
+                yield from self._read_split(sub_req)
+            return
+        yield from responses
+
+    def make_read_entities_requests(self, objects,
+                                    max_entities_per_request=64):
+        """Return the list of ReadRequests used by read_entities to read
+        'objects', and a dict mapping the key of the entities read to
+        the (kind, name) tuple of their object, for
+        demux_read_responses."""
+        owners = {}
+        seen = set()
+        reqs = []
+        for kind, name in objects:
+            if (kind, name) in seen:
+                continue
+            seen.add((kind, name))
+            if not reqs or len(reqs[-1].entities) >= max_entities_per_request:
+                req = p4runtime_pb2.ReadRequest()
+                req.device_id = self.device_id
+                reqs.append(req)
+            key = self._add_read_entity(reqs[-1], kind, name)
+            owners[key] = (kind, name)
+        return reqs, owners
+
+    def demux_read_responses(self, responses, owners, ret):
+        """Append the entries of the ReadResponse messages 'responses'
+        to the list of their object in the dict 'ret'.  Default
+        entries of tables whose default entry was not read are ignored,
+        since some servers return them in wildcard reads of the table."""
+        for response in responses:
+            for entity in response.entities:
+                key = self._read_entity_key(entity)
+                owner = owners.get(key)
+                if owner is None:
+                    if key[0] == 'table_entry' and key[2]:
+                        continue
+                    raise KeyError(key)
+                ret[owner].append(getattr(entity,
+                                          entity.WhichOneof('entity')))
+
     def push_update_add_entry_to_member(self, req, t_name, mk, mbr_id):
         update = req.updates.add()
         update.type = p4runtime_pb2.Update.INSERT
@@ -1037,21 +3138,104 @@ class P4RuntimeTest(BaseTest):
         self.push_update_add_entry_to_group(req, t_name, mk, grp_id)
         return req, self.write_request(req, store=(mk is not None))
 
-    # iterates over all requests in reverse order; if they are INSERT updates,
-    # replay them as DELETE updates; this is a convenient way to clean-up a lot
-    # of switch state
-    def undo_write_requests(self, reqs):
-        updates = []
-        for req in reversed(reqs):
-            for update in reversed(req.updates):
-                if update.type == p4runtime_pb2.Update.INSERT:
-                    updates.append(update)
-        new_req = p4runtime_pb2.WriteRequest()
-        new_req.device_id = self.device_id
-        for update in updates:
-            update.type = p4runtime_pb2.Update.DELETE
-            new_req.updates.add().CopyFrom(update)
-        rep = self._write(new_req)
+    # Deletes, in reverse order of insertion, all entities inserted by
+    # 'reqs', which is either a WriteJournal or a list of WriteRequest
+    # messages; this is a convenient way to clean-up a lot of switch
+    # state.  The DELETE updates are sent in WriteRequests of at most
+    # 'max_updates' updates.  With window > 1, consecutive batches that
+    # delete the same kind of entity are sent concurrently, so table
+    # entries are still all deleted before the action profile groups
+    # and members they point to.
+    #
+    # A failed batch does not stop the undo.  The records of the
+    # entities that were deleted are removed from the journal, and if
+    # any batch failed, P4RuntimeUndoException is raised at the end, or
+    # the list of (batch_index, num_updates, exception) tuples is
+    # returned if raise_errors is False.
+    def undo_write_requests(self, reqs, max_updates=1000, window=1,
+                            raise_errors=True):
+        if isinstance(reqs, WriteJournal):
+            journal = reqs
+        else:
+            journal = WriteJournal()
+            for req in reqs:
+                journal.append(req)
+        self.flush_write_batch()
+
+        # Split the records in batches, and the batches in phases of
+        # consecutive batches for the same kind of entity.
+        batches = []
+        for record in reversed(journal):
+            if (len(batches) == 0 or len(batches[-1]) >= max_updates or
+                    record.kind != batches[-1][0].kind):
+                batches.append([])
+            batches[-1].append(record)
+        phases = []
+        for records in batches:
+            if len(phases) == 0 or phases[-1][0][0].kind != records[0].kind:
+                phases.append([])
+            phases[-1].append(records)
+
+        def make_delete_request(records):
+            req = p4runtime_pb2.WriteRequest()
+            req.device_id = self.device_id
+            for record in records:
+                WriteJournal.set_delete_update(req.updates.add(), record)
+            return req
+
+        def batch_done(records, exc):
+            failed = set()
+            if isinstance(exc, P4RuntimeWriteException):
+                failed = set(idx for idx, _ in exc.errors)
+            elif exc is not None:
+                failed = set(range(len(records)))
+                failed.difference_update(written_update_indices(exc))
+            for idx, record in enumerate(records):
+                if idx not in failed:
+                    journal.discard(record)
+
+        batch_errors = []
+        batch_idx = 0
+        for phase in phases:
+            if window <= 1 or len(phase) == 1:
+                for records in phase:
+                    exc = None
+                    try:
+                        self._write(make_delete_request(records))
+                    except (P4RuntimeWriteException, grpc.RpcError) as e:
+                        exc = e
+                        batch_errors.append((batch_idx, len(records), e))
+                    batch_done(records, exc)
+                    batch_idx += 1
+                continue
+            futs = []
+            pl = self.pipeline(window)
+            max_bytes = self.channel_options.max_request_bytes
+            for records in phase:
+                # The pipeline sends each request as one RPC, so split
+                # here those that are too large.
+                chunks = split_write_request(make_delete_request(records),
+                                             max_bytes)
+                for i, (offset, req) in enumerate(chunks):
+                    end = (chunks[i + 1][0] if i + 1 < len(chunks)
+                           else len(records))
+                    futs.append((batch_idx, records[offset:end],
+                                 pl.write(req, store=False)))
+                batch_idx += 1
+            pl.drain(raise_errors=False)
+            pl.close()
+            for idx, records, fut in futs:
+                exc = fut.exception()
+                if exc is not None:
+                    batch_errors.append((idx, len(records), exc))
+                batch_done(records, exc)
+
+        for idx, num_updates, e in batch_errors:
+            logging.error("undo_write_requests: batch %d of %d updates failed: %s"
+                          "" % (idx, num_updates, e))
+        if raise_errors and len(batch_errors) > 0:
+            raise P4RuntimeUndoException(batch_errors)
+        return batch_errors
 
     def assertP4RuntimeError(self, code=None, msg_regexp=None):
         if msg_regexp is not None:
@@ -1068,7 +3252,11 @@ for obj_type, nickname in [("tables", "table"),
                            ("actions", "action"),
                            ("counters", "counter"),
                            ("direct_counters", "direct_counter"),
-                           ("controller_packet_metadata", "controller_packet_metadata")]:
+                           ("controller_packet_metadata", "controller_packet_metadata"),
+                           ("digests", "digest"),
+                           ("registers", "register"),
+                           ("meters", "meter"),
+                           ("direct_meters", "direct_meter")]:
     name = "_".join(["get", nickname])
     setattr(P4RuntimeTest, name, partialmethod(
         P4RuntimeTest.get_obj, obj_type))
@@ -1077,11 +3265,13 @@ for obj_type, nickname in [("tables", "table"),
         P4RuntimeTest.get_obj_id, obj_type))
 
 # this decorator can be used on the runTest method of P4Runtime PTF tests
-# when it is used, the undo_write_requests will be called at the end of the test
+# when it is used, reset_switch_state will be called at the end of the test
 # (irrespective of whether the test was a failure, a success, or an exception
-# was raised). When this is used, all write requests must be performed through
-# one of the send_request_* convenience functions, or by calling write_request;
-# do not use stub.Write directly!
+# was raised), which either calls undo_write_requests, or, if enabled with
+# reset_by_pipeline, installs the pipeline again if the test wrote a lot of
+# state (see reset_switch_state). When this is used, all write requests
+# must be performed through one of the send_request_* convenience
+# functions, or by calling write_request; do not use stub.Write directly!
 # most of the time, it is a great idea to use this decorator, as it makes the
 # tests less verbose. In some circumstances, it is difficult to use it, in
 # particular when the test itself issues DELETE request to remove some
@@ -1099,30 +3289,78 @@ def autocleanup(f):
         try:
             return f(*args, **kwargs)
         finally:
-            test.undo_write_requests(test._reqs)
+            test.reset_switch_state()
     return handle
 
 # Copied update_config from the https://github.com/p4lang/PI
 # repository in file proto/ptf/ptf_runner.py, then modified it
 # slightly:
 
-def update_config(config_path, p4info_path, grpc_addr, device_id):
+# The cookie stored with the pipelines installed by updateConfig and
+# update_config: the first 8 bytes of a SHA-256 hash of the P4Info and
+# the device config, so that a device already running the same pipeline
+# can be recognized.
+def pipeline_config_cookie(p4info_data, device_config):
+    h = hashlib.sha256()
+    h.update(p4info_data.SerializeToString(deterministic=True))
+    h.update(device_config)
+    return int.from_bytes(h.digest()[:8], byteorder='big')
+
+# Returns the cookie of the pipeline installed on the device, or None if
+# there is none or it could not be read.
+def get_pipeline_config_cookie(stub, device_id):
+    request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+    request.device_id = device_id
+    request.response_type = \
+        p4runtime_pb2.GetForwardingPipelineConfigRequest.COOKIE_ONLY
+    try:
+        response = stub.GetForwardingPipelineConfig(request)
+    except grpc.RpcError as e:
+        logging.debug("GetForwardingPipelineConfig failed: %s" % (e))
+        return None
+    if not response.config.HasField("cookie"):
+        return None
+    return response.config.cookie.cookie
+
+# Returns a SetForwardingPipelineConfigRequest installing on the device
+# the P4Info in the file 'p4info_path' and the binary device config in
+# the file 'config_path', with the cookie of pipeline_config_cookie.
+def make_pipeline_config_request(config_path, p4info_path, device_id):
+    request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+    request.device_id = device_id
+    request.action = \
+        p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+    config = request.config
+    p4info_data, _ = p4info_cache.load_p4info(p4info_path)
+    config.p4info.CopyFrom(p4info_data)
+    with open(config_path, 'rb') as config_f:
+        config.p4_device_config = config_f.read()
+    config.cookie.cookie = pipeline_config_cookie(config.p4info,
+                                                  config.p4_device_config)
+    return request
+
+def update_config(config_path, p4info_path, grpc_addr, device_id,
+                  force=False, channel_options=None):
     '''
     Performs a SetForwardingPipelineConfig on the device with provided
-    P4Info and binary device config
+    P4Info and binary device config, unless force is False and the
+    device already runs the same pipeline (see pipeline_config_cookie).
+    The channel is opened with 'channel_options', a ChannelOptions, or
+    the default ones if None.
     '''
-    channel = grpc.insecure_channel(grpc_addr)
+    if channel_options is None:
+        channel_options = ChannelOptions()
+    channel = channel_options.open_channel(grpc_addr)
     stub = p4runtime_pb2_grpc.P4RuntimeStub(channel)
     print("Sending P4 config from file {} with P4info {}".format(
         config_path, p4info_path))
-    request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
-    request.device_id = device_id
-    config = request.config
-    with open(p4info_path, 'r') as p4info_f:
-        google.protobuf.text_format.Merge(p4info_f.read(), config.p4info)
-    with open(config_path, 'rb') as config_f:
-        config.p4_device_config = config_f.read()
-    request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+    request = make_pipeline_config_request(config_path, p4info_path,
+                                           device_id)
+    if not force and (get_pipeline_config_cookie(stub, device_id) ==
+                      request.config.cookie.cookie):
+        print("Device {} already runs this P4 config, not sending it again".format(
+            device_id))
+        return True
     try:
         response = stub.SetForwardingPipelineConfig(request)
     except Exception as e:
@@ -1130,3 +3368,249 @@ def update_config(config_path, p4info_path, grpc_addr, device_id):
         print(str(e), file=sys.stderr)
         return False
     return True
+
+# Returned by the methods of MultiDeviceClient, one per device.  'ok' is
+# False if the operation failed on the device, with the exception in
+# 'error', and 'value' is what the operation returned otherwise.
+# 'seconds' is the time it took on that device.
+DeviceResult = namedtuple('DeviceResult',
+                          ['device_id', 'ok', 'seconds', 'value', 'error'])
+
+# Raised by MultiDeviceClient.connect when the connection to some of
+# the devices failed.  results is the dict of DeviceResult returned
+# by connect.
+class P4RuntimeMultiDeviceException(Exception):
+    def __init__(self, results):
+        super(P4RuntimeMultiDeviceException, self).__init__()
+        self.results = results
+
+    def __str__(self):
+        message = "Error(s) on some devices:\n"
+        for device_id, result in sorted(self.results.items()):
+            if not result.ok:
+                message += "\t* Device {}: {}\n".format(
+                    device_id, str(result.error).strip())
+        return message
+
+class MultiDeviceClient(object):
+    """A P4Runtime client of several devices, e.g. all the switches of
+    a topology, which runs the same operation on all of them in
+    parallel, with one thread per device.  'devices' is a dict mapping
+    each device id to the gRPC address of its server.  Each device
+    gets its own P4RuntimeSession, i.e. channel and StreamChannel,
+    opened with 'channel_options' (the default ChannelOptions if None).
+
+        with MultiDeviceClient({1: 'localhost:50051',
+                                2: 'localhost:50052'}) as client:
+            client.set_pipeline_config(config_path, p4info_path)
+            results = client.write(updates)
+
+    Every method returns a dict mapping each device id to a
+    DeviceResult, with the time the operation took on that device,
+    and its error if it failed there.  A failure on one device does
+    not stop the operation on the others."""
+
+    def __init__(self, devices, channel_options=None, max_workers=None,
+                 arbitration_timeout=2):
+        assert len(devices) > 0
+        self.devices = dict(devices)
+        if channel_options is None:
+            channel_options = ChannelOptions()
+        self.channel_options = channel_options
+        self.arbitration_timeout = arbitration_timeout
+        # device id -> P4RuntimeSession, of the connected devices
+        self.sessions = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(self.devices))
+
+    def run(self, fn, device_ids=None):
+        """Call fn(device_id, session) for each device in 'device_ids',
+        all connected devices if None, in parallel, and return a dict
+        of DeviceResult with the value returned by each call."""
+        if device_ids is None:
+            device_ids = sorted(self.sessions)
+
+        def timed(device_id):
+            start = time.time()
+            try:
+                session = self.sessions.get(device_id)
+                if session is None:
+                    raise KeyError("Device %s is not connected"
+                                   "" % (device_id))
+                value = fn(device_id, session)
+            except Exception as e:
+                logging.error("Device %s: %s" % (device_id, e))
+                return DeviceResult(device_id, False, time.time() - start,
+                                    None, e)
+            return DeviceResult(device_id, True, time.time() - start,
+                                value, None)
+
+        futs = {device_id: self._executor.submit(timed, device_id)
+                for device_id in device_ids}
+        return {device_id: fut.result() for device_id, fut in futs.items()}
+
+    def connect(self, raise_errors=True):
+        """Open a session to every device and do the arbitration
+        handshake on it, in parallel.  Raises a
+        P4RuntimeMultiDeviceException if some of them failed and
+        'raise_errors' is True, after closing the sessions that were
+        opened."""
+        def connect_one(device_id):
+            start = time.time()
+            session = None
+            try:
+                session = P4RuntimeSession(
+                    self.devices[device_id], device_id,
+                    channel_options=self.channel_options)
+                req = p4runtime_pb2.StreamMessageRequest()
+                # Election id 0, as in P4RuntimeTest.handshake
+                req.arbitration.device_id = device_id
+                session.send(req)
+                if session.stream_in_q.get(
+                        'arbitration', self.arbitration_timeout) is None:
+                    raise RuntimeError("Failed to establish handshake with"
+                                       " %s" % (self.devices[device_id]))
+            except Exception as e:
+                logging.error("Device %s: %s" % (device_id, e))
+                if session is not None:
+                    self._close_session(session)
+                return DeviceResult(device_id, False, time.time() - start,
+                                    None, e)
+            session.arbitrated = True
+            self.sessions[device_id] = session
+            return DeviceResult(device_id, True, time.time() - start,
+                                session, None)
+
+        futs = {device_id: self._executor.submit(connect_one, device_id)
+                for device_id in sorted(self.devices)
+                if device_id not in self.sessions}
+        results = {device_id: fut.result()
+                   for device_id, fut in futs.items()}
+        if raise_errors and not all(r.ok for r in results.values()):
+            self.close()
+            raise P4RuntimeMultiDeviceException(results)
+        return results
+
+    def set_pipeline_config(self, config_path, p4info_path, force=False,
+                            device_ids=None):
+        """Install the P4 program compiled to 'config_path', with the
+        P4Info in 'p4info_path', on the devices, like update_config.
+        Either path can also be a dict mapping device ids to paths, for
+        topologies with different programs on some devices.  Unless
+        'force' is True, a device is skipped if it already runs the
+        same pipeline (see pipeline_config_cookie).  The value of each
+        DeviceResult is True if the pipeline was sent, and False if it
+        was skipped."""
+        if device_ids is None:
+            device_ids = sorted(self.sessions)
+        for p in (config_path, p4info_path):
+            if isinstance(p, dict):
+                missing = [d for d in device_ids if d not in p]
+                if missing:
+                    raise ValueError("No path for device(s) %s in %r"
+                                     "" % (missing, p))
+        # Build each distinct request only once, since the device
+        # config can be large.
+        requests = {}
+        lock = threading.Lock()
+
+        def get_request(device_id):
+            paths = tuple(p[device_id] if isinstance(p, dict) else p
+                          for p in (config_path, p4info_path))
+            with lock:
+                request = requests.get(paths)
+                if request is None:
+                    request = make_pipeline_config_request(paths[0],
+                                                           paths[1], 0)
+                    requests[paths] = request
+            return request
+
+        def push(device_id, session):
+            template = get_request(device_id)
+            if not force and (get_pipeline_config_cookie(session.stub,
+                                                         device_id) ==
+                              template.config.cookie.cookie):
+                logging.info("Device %s already runs this pipeline, not"
+                             " sending it again" % (device_id))
+                return False
+            request = p4runtime_pb2.SetForwardingPipelineConfigRequest()
+            request.CopyFrom(template)
+            request.device_id = device_id
+            session.stub.SetForwardingPipelineConfig(request)
+            return True
+
+        return self.run(push, device_ids)
+
+    def write(self, updates, max_updates=1000, device_ids=None):
+        """Write the Update messages of the sequence 'updates' to each
+        device, or, if 'updates' is a dict, the sequence updates[device_id]
+        to each device in it, in WriteRequests of at most 'max_updates'
+        updates, each split further if it is too large (see
+        write_split).  The value of each DeviceResult is the number of
+        updates written.  If some of them failed, its error is a
+        P4RuntimeWriteException listing the failed updates with their
+        index in the device's sequence of updates."""
+        if isinstance(updates, dict) and device_ids is None:
+            device_ids = sorted(updates)
+        max_bytes = self.channel_options.max_request_bytes
+
+        def write_all(device_id, session):
+            device_updates = (updates[device_id]
+                              if isinstance(updates, dict) else updates)
+            exc = None
+            for offset in range(0, len(device_updates), max_updates):
+                req = p4runtime_pb2.WriteRequest()
+                req.device_id = device_id
+                req.updates.extend(
+                    device_updates[offset:offset + max_updates])
+                try:
+                    write_split(session.stub, req, max_bytes)
+                except P4RuntimeWriteException as e:
+                    errors = [(offset + idx, p4_error)
+                              for idx, p4_error in e.errors]
+                    if exc is None:
+                        exc = e
+                        exc.errors = errors
+                    else:
+                        exc.errors.extend(errors)
+            if exc is not None:
+                raise exc
+            return len(device_updates)
+
+        return self.run(write_all, device_ids)
+
+    @staticmethod
+    def summary(results):
+        """Return a dict with the number of devices on which the
+        operation that returned 'results' succeeded and failed, and
+        the longest and total time it took on a device."""
+        seconds = [r.seconds for r in results.values()]
+        return {'ok': sum(1 for r in results.values() if r.ok),
+                'failed': sum(1 for r in results.values() if not r.ok),
+                'max_seconds': max(seconds) if seconds else 0.0,
+                'total_seconds': sum(seconds)}
+
+    @staticmethod
+    def _close_session(session):
+        try:
+            session.close()
+        except Exception as e:
+            logging.warning("Error while closing P4Runtime session to %s:"
+                            " %s" % (session.grpc_addr, e))
+
+    def close(self):
+        """Close the sessions of all devices, and stop the threads.  The
+        client cannot be used any more afterwards."""
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            self._close_session(session)
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
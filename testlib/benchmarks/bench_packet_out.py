@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of PacketOut messages per second, without any switch.
+#
+# It compares building each message with encode_packet_out_metadata()
+# and send_packet_out(), with send_packet_outs() and a PacketOutEncoder.
+# Messages go through a bounded stream_out_q, emptied by a thread that
+# plays the role of the gRPC stream, as in P4RuntimeSession.  Run it
+# from the testlib directory, or with testlib in PYTHONPATH:
+#
+#     python3 benchmarks/bench_packet_out.py [--fields 4] [--count 100000]
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from base_test import P4RuntimeTest
+from bench_table_entry import make_p4info, make_test
+
+
+class FakeSession(object):
+    """The parts of P4RuntimeSession used to send stream messages, with
+    a thread that discards them instead of a gRPC stream."""
+
+    def __init__(self, capacity):
+        self.stream_out_q = queue.Queue(maxsize=capacity)
+        self.messages_queued = 0
+        self.messages_sent = 0
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            p = self.stream_out_q.get()
+            if p is None:
+                break
+            self.messages_sent += 1
+
+    def send(self, req, timeout=None):
+        self.stream_out_q.put(req, timeout=timeout)
+        self.messages_queued += 1
+
+    def close(self):
+        self.stream_out_q.put(None)
+        self.thread.join()
+
+
+def bench(fn, test, count, capacity):
+    test.session = FakeSession(capacity)
+    start = time.perf_counter()
+    fn(test, count)
+    test.session.close()
+    elapsed = time.perf_counter() - start
+    assert test.session.messages_sent == count
+    return count / elapsed
+
+
+def send_one_by_one(test, count):
+    names = [f['name'] for f in
+             test.get_packet_metadata_info("packet_out").fields]
+    for i in range(count):
+        pktout = {'payload': b"\x00" * 64,
+                  'metadata': {name: i & 0xffff for name in names}}
+        test.send_packet_out(test.encode_packet_out_metadata(pktout))
+
+
+def send_bulk(test, count):
+    encoder = test.make_packet_out_encoder()
+    num_fields = len(encoder.field_names)
+    test.send_packet_outs(((b"\x00" * 64, [i & 0xffff] * num_fields)
+                           for i in range(count)), encoder)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fields', type=int, default=4,
+                        help='metadata fields in the packet_out header')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='PacketOut messages per measurement')
+    parser.add_argument('--capacity', type=int, default=10000,
+                        help='capacity of stream_out_q')
+    args = parser.parse_args()
+
+    test = make_test(P4RuntimeTest, make_p4info(args.fields))
+    results = []
+    for name, fn in [("send_packet_out", send_one_by_one),
+                     ("send_packet_outs", send_bulk)]:
+        r = bench(fn, test, args.count, args.capacity)
+        results.append(r)
+        print("%-18s %10.0f PacketOut/s" % (name, r))
+    print("%-18s %10.2fx" % ("speedup", results[1] / results[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Microbenchmark of the P4RuntimeTest helpers that build table entries
+# and encode/decode controller packet metadata, without any switch.
+#
+# It compares the current helpers, which use the P4InfoIndex built in
+# import_p4info_names(), with the linear scans they used before, and
+# prints the number of operations per second of each.  Run it from the
+# testlib directory, or with testlib in PYTHONPATH:
+#
+#     python3 benchmarks/bench_table_entry.py [--fields 8] [--count 20000]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
+
+from base_test import P4RuntimeTest, stringify
+
+
+def make_p4info(num_fields):
+    """Return a P4Info message with one table with 'num_fields' exact
+    match fields, one action with 'num_fields' parameters, and
+    packet_in/packet_out headers with 'num_fields' metadata fields."""
+    p4info = p4info_pb2.P4Info()
+    table = p4info.tables.add()
+    table.preamble.id = 1
+    table.preamble.name = "MyIngress.bench_table"
+    action = p4info.actions.add()
+    action.preamble.id = 2
+    action.preamble.name = "MyIngress.bench_action"
+    table.action_refs.add().id = action.preamble.id
+    for i in range(num_fields):
+        mf = table.match_fields.add()
+        mf.id = i + 1
+        mf.name = "hdr.f%d" % (i)
+        mf.bitwidth = 32
+        mf.match_type = p4info_pb2.MatchField.EXACT
+        p = action.params.add()
+        p.id = i + 1
+        p.name = "p%d" % (i)
+        p.bitwidth = 32
+    for cpm_id, cpm_name in [(3, "packet_in"), (4, "packet_out")]:
+        cpm = p4info.controller_packet_metadata.add()
+        cpm.preamble.id = cpm_id
+        cpm.preamble.name = cpm_name
+        for i in range(num_fields):
+            md = cpm.metadata.add()
+            md.id = i + 1
+            md.name = "m%d" % (i)
+            md.bitwidth = 16
+    return p4info
+
+
+def make_test(cls, p4info):
+    # Only the P4Info related state set up by setUp() is needed.
+    test = cls.__new__(cls)
+    test.p4info = p4info
+    test.import_p4info_names()
+    return test
+
+
+class LinearScanTest(P4RuntimeTest):
+    """The lookups as they were implemented before P4InfoIndex."""
+
+    def get_param_id(self, action_name, name):
+        a = self.get_obj("actions", action_name)
+        for p in a.params:
+            if p.name == name:
+                return p.id
+
+    def get_mf_by_name(self, table_name, field_name):
+        t = self.get_obj("tables", table_name)
+        for mf in t.match_fields:
+            if mf.name == field_name:
+                return mf
+
+    def set_match_key(self, table_entry, t_name, mk):
+        for mf in mk:
+            mf_obj = self.get_mf_by_name(t_name, mf.name)
+            mf.add_to(mf_obj.id, mf_obj.bitwidth, table_entry.match)
+
+    def set_action(self, action, a_name, params):
+        action.action_id = self.get_action_id(a_name)
+        for p_name, v in params:
+            param = action.params.add()
+            param.param_id = self.get_param_id(a_name, p_name)
+            param.value = stringify(v)
+
+    def controller_packet_metadata_dict_key_id(self, name):
+        cpm_info = self.get_controller_packet_metadata(name)
+        ret = {}
+        for md in cpm_info.metadata:
+            ret[md.id] = {'id': md.id, 'name': md.name,
+                          'bitwidth': md.bitwidth}
+        return ret
+
+    def controller_packet_metadata_dict_key_name(self, name):
+        cpm_info = self.get_controller_packet_metadata(name)
+        ret = {}
+        for md in cpm_info.metadata:
+            ret[md.name] = {'id': md.id, 'name': md.name,
+                            'bitwidth': md.bitwidth}
+        return ret
+
+
+def rate(fn, count):
+    start = time.perf_counter()
+    fn(count)
+    return count / (time.perf_counter() - start)
+
+
+def bench_table_entries(test, num_fields, count):
+    field_names = ["hdr.f%d" % (i) for i in range(num_fields)]
+    param_names = ["p%d" % (i) for i in range(num_fields)]
+
+    def run(n):
+        for i in range(n):
+            key = [P4RuntimeTest.Exact(f, i) for f in field_names]
+            params = [(p, i) for p in param_names]
+            test.make_table_entry(("bench_table", key),
+                                  ("bench_action", params))
+    return rate(run, count)
+
+
+def bench_packet_in_decode(test, num_fields, count):
+    packet = p4runtime_pb2.PacketIn()
+    packet.payload = b"\x00" * 64
+    for i in range(num_fields):
+        md = packet.metadata.add()
+        md.metadata_id = i + 1
+        md.value = stringify(i, 2)
+
+    def run(n):
+        for _ in range(n):
+            test.decode_packet_in_metadata(packet)
+    return rate(run, count)
+
+
+def bench_packet_out_encode(test, num_fields, count):
+    pktout = {'payload': b"\x00" * 64,
+              'metadata': {"m%d" % (i): i for i in range(num_fields)}}
+
+    def run(n):
+        for _ in range(n):
+            test.encode_packet_out_metadata(pktout)
+    return rate(run, count)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fields', type=int, default=8,
+                        help='match fields, action params and metadata '
+                        'fields per object')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='operations per measurement')
+    args = parser.parse_args()
+
+    p4info = make_p4info(args.fields)
+    tests = [("linear scan", make_test(LinearScanTest, p4info)),
+             ("P4InfoIndex", make_test(P4RuntimeTest, p4info))]
+    for bench_name, bench in [("table entries", bench_table_entries),
+                              ("PacketIn decodes", bench_packet_in_decode),
+                              ("PacketOut encodes", bench_packet_out_encode)]:
+        results = [(name, bench(test, args.fields, args.count))
+                   for name, test in tests]
+        for name, r in results:
+            print("%-18s %-12s %10.0f /s" % (bench_name, name, r))
+        print("%-18s speedup      %10.2fx" % (bench_name,
+                                              results[1][1] / results[0][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Versions of stringify, ipv4_to_binary, mac_to_binary and friends from
+# base_test.py that convert a whole sequence of values at once, for
+# generating the large key sets of scale tests.  They are re-exported by
+# base_test.py and p4runtime_shell_utils.py.
+#
+# All of them accept any iterable, including a NumPy array, and return a
+# list.  The *_to_binary functions return the full width encoding of
+# each value (4 bytes for IPv4, 6 for MAC, 16 for IPv6) by default, or
+# the minimum width encoding returned by stringify() if
+# min_width=True.  The results can be used directly as values in the
+# rows passed to TableEntryBuilder.
+
+import socket
+
+_AF_INET = socket.AF_INET
+_AF_INET6 = socket.AF_INET6
+_inet_pton = socket.inet_pton
+
+
+def _as_list(values):
+    # NumPy arrays and scalars convert to Python ints much faster with
+    # tolist() than element by element.
+    tolist = getattr(values, 'tolist', None)
+    if tolist is not None:
+        return tolist()
+    return values
+
+
+def _min_width(b):
+    # Same as stringify(int.from_bytes(b, 'big'))
+    return b.lstrip(b'\x00') or b'\x00'
+
+
+def stringify_many(values, length=0):
+    """Return [stringify(n, length) for n in values], i.e. each value
+    encoded in 'length' bytes, or in the fewest bytes it fits in if it
+    does not fit in 'length' bytes."""
+    ret = []
+    append = ret.append
+    for n in _as_list(values):
+        n_len = (n.bit_length() + 7) // 8
+        if n_len < length:
+            n_len = length
+        elif n_len == 0:
+            n_len = 1
+        append(n.to_bytes(n_len, byteorder='big'))
+    return ret
+
+
+def pack_fixed_width(values, length):
+    """Return a single bytes object containing every value of 'values'
+    encoded in exactly 'length' bytes, big endian, one after the other.
+    Raises OverflowError if a value does not fit."""
+    astype = getattr(values, 'astype', None)
+    dtype = getattr(values, 'dtype', None)
+    if (astype is not None and length in (1, 2, 4, 8) and
+            getattr(dtype, 'kind', None) in ('i', 'u')):
+        # astype() wraps values that do not fit instead of raising.
+        if values.size > 0 and (int(values.min()) < 0 or
+                                int(values.max()) >= 256 ** length):
+            raise OverflowError("Value out of range for %d bytes"
+                                "" % (length))
+        return astype('>u%d' % (length)).tobytes()
+    return b''.join([n.to_bytes(length, byteorder='big')
+                     for n in _as_list(values)])
+
+
+def unpack_fixed_width(data, length):
+    """The inverse of pack_fixed_width: return the list of ints encoded
+    in 'data', 'length' bytes each."""
+    assert len(data) % length == 0
+    from_bytes = int.from_bytes
+    return [from_bytes(data[i:i + length], byteorder='big')
+            for i in range(0, len(data), length)]
+
+
+def ipv4s_to_binary(addrs, min_width=False):
+    ret = [_inet_pton(_AF_INET, addr) for addr in _as_list(addrs)]
+    if min_width:
+        ret = [_min_width(b) for b in ret]
+    return ret
+
+
+def ipv4s_to_int(addrs):
+    from_bytes = int.from_bytes
+    return [from_bytes(_inet_pton(_AF_INET, addr), byteorder='big')
+            for addr in _as_list(addrs)]
+
+
+def ipv6s_to_binary(addrs, min_width=False):
+    ret = [_inet_pton(_AF_INET6, addr) for addr in _as_list(addrs)]
+    if min_width:
+        ret = [_min_width(b) for b in ret]
+    return ret
+
+
+def ipv6s_to_int(addrs):
+    from_bytes = int.from_bytes
+    return [from_bytes(_inet_pton(_AF_INET6, addr), byteorder='big')
+            for addr in _as_list(addrs)]
+
+
+def _mac_to_binary(addr):
+    if len(addr) == 17:
+        b = bytes.fromhex(addr.replace(':', ''))
+    else:
+        # Some bytes written with a single hex digit, e.g. '0:1:2:3:4:5'
+        b = bytes([int(x, 16) for x in addr.split(':')])
+    if len(b) != 6:
+        raise ValueError("Invalid MAC address '%s'" % (addr))
+    return b
+
+
+def macs_to_binary(addrs, min_width=False):
+    ret = [_mac_to_binary(addr) for addr in _as_list(addrs)]
+    if min_width:
+        ret = [_min_width(b) for b in ret]
+    return ret
+
+
+def macs_to_int(addrs):
+    from_bytes = int.from_bytes
+    return [from_bytes(_mac_to_binary(addr), byteorder='big')
+            for addr in _as_list(addrs)]
@@ -0,0 +1,167 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Writes the entries read from a switch, e.g. by the generators
+# table_entries_iter() and counter_entries_iter() of P4RuntimeTest, to a
+# file one at a time, so that dumping a large table never needs all of
+# its entries in memory.
+#
+# Two formats are supported:
+#
+# 'jsonl': one JSON object per line, as returned by
+#     google.protobuf.json_format.MessageToDict() with the field names
+#     of the .proto files.  Entries that are not protobuf messages, e.g.
+#     dicts returned by a projection function, are written as they are.
+# 'binary': each message serialized in binary protobuf format, preceded
+#     by its length as a varint, the format of writeDelimitedTo() in the
+#     Java and C++ protobuf libraries.  Read it back with
+#     read_delimited().
+#
+# The entries of p4runtime_sh, e.g. sh.TableEntry objects, are written
+# as the P4Runtime message returned by their msg() method.
+
+import json
+
+from google.protobuf.json_format import MessageToDict, ParseDict
+from google.protobuf.message import Message
+
+
+def _as_message(entry):
+    if isinstance(entry, Message):
+        return entry
+    msg = getattr(entry, 'msg', None)
+    if callable(msg):
+        return msg()
+    return None
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(f):
+    shift = 0
+    n = 0
+    while True:
+        b = f.read(1)
+        if not b:
+            if shift == 0:
+                return None
+            raise ValueError("Truncated length prefix")
+        n |= (b[0] & 0x7f) << shift
+        if b[0] < 0x80:
+            return n
+        shift += 7
+
+
+def write_jsonl(entries, f):
+    """Write every entry of the iterable 'entries' to the text file
+    object 'f' in 'jsonl' format, and return the number written."""
+    n = 0
+    for entry in entries:
+        msg = _as_message(entry)
+        if msg is not None:
+            entry = MessageToDict(msg, preserving_proto_field_name=True)
+        f.write(json.dumps(entry))
+        f.write("\n")
+        n += 1
+    return n
+
+
+def write_delimited(entries, f):
+    """Write every message of the iterable 'entries' to the binary file
+    object 'f' in 'binary' format, and return the number written."""
+    n = 0
+    for entry in entries:
+        msg = _as_message(entry)
+        if msg is None:
+            raise TypeError("Cannot write %s in binary format, it is not"
+                            " a protobuf message" % (type(entry).__name__))
+        data = msg.SerializeToString()
+        f.write(_varint(len(data)))
+        f.write(data)
+        n += 1
+    return n
+
+
+def read_delimited(f, message_class):
+    """Generator yielding the messages of type 'message_class', e.g.
+    p4runtime_pb2.TableEntry, written to the binary file object 'f' by
+    write_delimited()."""
+    while True:
+        length = _read_varint(f)
+        if length is None:
+            return
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError("Truncated message")
+        msg = message_class()
+        msg.ParseFromString(data)
+        yield msg
+
+
+def read_jsonl(f, message_class=None):
+    """Generator yielding the entries written to the text file object
+    'f' by write_jsonl(), as messages of type 'message_class', or as
+    dicts if it is None."""
+    for line in f:
+        if not line.strip():
+            continue
+        d = json.loads(line)
+        if message_class is None:
+            yield d
+        else:
+            yield ParseDict(d, message_class())
+
+
+def file_format(fname):
+    if fname.endswith(".jsonl") or fname.endswith(".json"):
+        return 'jsonl'
+    return 'binary'
+
+
+def dump_entries(entries, fname, fmt=None):
+    """Write the entries of the iterable 'entries' to the file named
+    'fname', in format 'fmt', 'jsonl' or 'binary'.  If 'fmt' is None,
+    it is 'jsonl' for files named *.jsonl or *.json, and 'binary'
+    otherwise.  Returns the number of entries written."""
+    if fmt is None:
+        fmt = file_format(fname)
+    if fmt == 'jsonl':
+        with open(fname, 'w') as f:
+            return write_jsonl(entries, f)
+    if fmt == 'binary':
+        with open(fname, 'wb') as f:
+            return write_delimited(entries, f)
+    raise ValueError("Unknown dump format '%s'" % (fmt))
+
+
+def load_entries(fname, message_class, fmt=None):
+    """Generator yielding the entries of a file written by
+    dump_entries(), as messages of type 'message_class'."""
+    if fmt is None:
+        fmt = file_format(fname)
+    if fmt == 'jsonl':
+        with open(fname, 'r') as f:
+            yield from read_jsonl(f, message_class)
+    elif fmt == 'binary':
+        with open(fname, 'rb') as f:
+            yield from read_delimited(f, message_class)
+    else:
+        raise ValueError("Unknown dump format '%s'" % (fmt))
@@ -0,0 +1,135 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Options of the gRPC channels opened by the P4Runtime helpers, and
+# splitting of bulk WriteRequests so that no request is larger than the
+# server accepts.
+#
+# By default, gRPC rejects received messages larger than 4 MB, on both
+# ends of a channel.  The client side limit is raised here, so that
+# large ReadResponses and GetForwardingPipelineConfigResponses can be
+# received.  The limit of the server cannot be changed, nor even
+# learned, by the client, so requests are instead kept under
+# 'max_request_bytes', a little less than the gRPC default.  Raise it
+# only for a server started with a larger limit.
+
+import grpc
+
+MiB = 1024 * 1024
+
+DEFAULT_MAX_MESSAGE_SIZE = 256 * MiB
+DEFAULT_MAX_REQUEST_BYTES = 4 * MiB - 64 * 1024
+
+COMPRESSION_ALGORITHMS = {
+    'none': grpc.Compression.NoCompression,
+    'deflate': grpc.Compression.Deflate,
+    'gzip': grpc.Compression.Gzip,
+}
+
+
+class ChannelOptions(object):
+    """The options of a gRPC channel to a P4Runtime server.
+
+    'max_message_size' is the largest message the client sends or
+    receives, 'max_request_bytes' the largest Write request sent as a
+    single RPC (see split_write_request), 'keepalive_time_ms' the
+    interval of HTTP/2 keepalive pings, 0 to disable them, and
+    'compression' the name of the compression algorithm of the
+    messages sent, one of the keys of COMPRESSION_ALGORITHMS, or None
+    for the gRPC default (no compression)."""
+
+    def __init__(self, max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                 max_request_bytes=DEFAULT_MAX_REQUEST_BYTES,
+                 keepalive_time_ms=0, keepalive_timeout_ms=20000,
+                 compression=None):
+        if compression is not None and \
+                compression not in COMPRESSION_ALGORITHMS:
+            raise ValueError("Unknown gRPC compression algorithm '%s'"
+                             "" % (compression))
+        assert max_request_bytes > 0
+        self.max_message_size = int(max_message_size)
+        self.max_request_bytes = int(max_request_bytes)
+        self.keepalive_time_ms = int(keepalive_time_ms)
+        self.keepalive_timeout_ms = int(keepalive_timeout_ms)
+        self.compression = compression
+
+    def grpc_options(self):
+        """Return the list of (key, value) channel arguments passed to
+        grpc.insecure_channel."""
+        options = [
+            ('grpc.max_send_message_length', self.max_message_size),
+            ('grpc.max_receive_message_length', self.max_message_size),
+        ]
+        if self.keepalive_time_ms > 0:
+            options += [
+                ('grpc.keepalive_time_ms', self.keepalive_time_ms),
+                ('grpc.keepalive_timeout_ms', self.keepalive_timeout_ms),
+                ('grpc.keepalive_permit_without_calls', 1),
+                ('grpc.http2.max_pings_without_data', 0),
+            ]
+        return options
+
+    def grpc_compression(self):
+        if self.compression is None:
+            return None
+        return COMPRESSION_ALGORITHMS[self.compression]
+
+    def open_channel(self, grpc_addr):
+        return grpc.insecure_channel(grpc_addr, options=self.grpc_options(),
+                                     compression=self.grpc_compression())
+
+
+def _varint_len(n):
+    ret = 1
+    while n > 0x7f:
+        n >>= 7
+        ret += 1
+    return ret
+
+
+def _field_len(msg):
+    # Size of 'msg' as an element of a repeated field: its tag (a field
+    # number < 16 takes 1 byte), its length and its data.
+    size = msg.ByteSize()
+    return 1 + _varint_len(size) + size
+
+
+def split_write_request(req, max_bytes):
+    """Return a list of (offset, WriteRequest) tuples: 'req' itself at
+    offset 0 if it is at most 'max_bytes' bytes long, otherwise copies
+    of 'req' with consecutive slices of its updates, each at most
+    'max_bytes' bytes long unless it has a single update, and the
+    index in 'req' of their first update.  Atomic requests, i.e. with
+    an atomicity other than CONTINUE_ON_ERROR, are never split."""
+    if req.ByteSize() <= max_bytes or len(req.updates) <= 1 or \
+            req.atomicity != req.CONTINUE_ON_ERROR:
+        return [(0, req)]
+    header = type(req)()
+    header.CopyFrom(req)
+    header.ClearField('updates')
+    header_len = header.ByteSize()
+    ret = []
+    chunk = None
+    chunk_len = 0
+    for idx, update in enumerate(req.updates):
+        update_len = _field_len(update)
+        if chunk is None or (chunk_len + update_len > max_bytes and
+                             len(chunk.updates) > 0):
+            chunk = type(req)()
+            chunk.CopyFrom(header)
+            chunk_len = header_len
+            ret.append((idx, chunk))
+        chunk.updates.add().CopyFrom(update)
+        chunk_len += update_len
+    return ret
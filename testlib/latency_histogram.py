@@ -0,0 +1,137 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A latency histogram with the bucket layout of HdrHistogram
+# (http://hdrhistogram.org): values are recorded in integer nanoseconds,
+# in buckets whose width grows with the value, so that every recorded
+# value is known with at least 'significant_digits' decimal digits of
+# precision, whatever its magnitude.  Only the buckets with a non-zero
+# count are stored.
+
+import json
+import math
+
+
+class LatencyHistogram(object):
+    def __init__(self, significant_digits=3):
+        assert 1 <= significant_digits <= 5
+        self.significant_digits = significant_digits
+        # Smallest power of 2 number of sub-buckets giving the requested
+        # precision
+        largest_single_unit = 2 * 10 ** significant_digits
+        self._sub_bucket_bits = int(math.ceil(math.log2(largest_single_unit)))
+        self._sub_bucket_half = 1 << (self._sub_bucket_bits - 1)
+        # bucket index -> count
+        self._counts = {}
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+
+    def _index(self, value_ns):
+        bucket = max(0, value_ns.bit_length() - self._sub_bucket_bits)
+        return bucket * self._sub_bucket_half + (value_ns >> bucket)
+
+    def _range(self, index):
+        # Lowest and highest values that are recorded at index
+        bucket = max(0, index // self._sub_bucket_half - 1)
+        sub = index - bucket * self._sub_bucket_half
+        return sub << bucket, ((sub + 1) << bucket) - 1
+
+    def record_ns(self, value_ns, count=1):
+        value_ns = int(value_ns)
+        if value_ns < 0:
+            # Clock adjustments can make a few samples negative.
+            value_ns = 0
+        idx = self._index(value_ns)
+        self._counts[idx] = self._counts.get(idx, 0) + count
+        self.count += count
+        self.total_ns += value_ns * count
+        if self.min_ns is None or value_ns < self.min_ns:
+            self.min_ns = value_ns
+        if self.max_ns is None or value_ns > self.max_ns:
+            self.max_ns = value_ns
+
+    def record(self, seconds):
+        self.record_ns(round(seconds * 1e9))
+
+    def merge(self, other):
+        assert other.significant_digits == self.significant_digits
+        for idx, c in other._counts.items():
+            self._counts[idx] = self._counts.get(idx, 0) + c
+        self.count += other.count
+        self.total_ns += other.total_ns
+        for v in (other.min_ns, other.max_ns):
+            if v is None:
+                continue
+            if self.min_ns is None or v < self.min_ns:
+                self.min_ns = v
+            if self.max_ns is None or v > self.max_ns:
+                self.max_ns = v
+
+    def mean_ns(self):
+        if self.count == 0:
+            return None
+        return self.total_ns / self.count
+
+    def percentile_ns(self, percentile):
+        """Return the value in nanoseconds below or at which
+        'percentile' percent of the recorded values are, or None if the
+        histogram is empty.  As in HdrHistogram, this is the highest
+        value of the bucket containing that value, capped by the
+        largest recorded value."""
+        if self.count == 0:
+            return None
+        target = max(1, int(math.ceil(percentile / 100.0 * self.count)))
+        seen = 0
+        for idx in sorted(self._counts):
+            seen += self._counts[idx]
+            if seen >= target:
+                return min(self._range(idx)[1], self.max_ns)
+        return self.max_ns
+
+    def buckets(self):
+        """Return a list of (lowest_ns, highest_ns, count) tuples, one
+        for each bucket with a non-zero count, in increasing order."""
+        return [self._range(idx) + (self._counts[idx],)
+                for idx in sorted(self._counts)]
+
+    def summary(self, percentiles=(50, 90, 99, 99.9, 100)):
+        """Return a dict with the count, min, mean and max, and the
+        given percentiles, of the recorded values, in microseconds."""
+        def us(v):
+            return None if v is None else v / 1000.0
+        return {'count': self.count,
+                'min_us': us(self.min_ns),
+                'mean_us': us(self.mean_ns()),
+                'max_us': us(self.max_ns),
+                'percentiles_us': {str(p): us(self.percentile_ns(p))
+                                   for p in percentiles}}
+
+    def to_dict(self):
+        d = self.summary()
+        d['significant_digits'] = self.significant_digits
+        d['buckets_ns'] = [list(b) for b in self.buckets()]
+        return d
+
+    def to_json(self, fname=None):
+        """Return the histogram, with its summary and all non-empty
+        buckets, as a JSON string, also written to the file named
+        'fname' if it is not None."""
+        s = json.dumps(self.to_dict(), indent=2)
+        if fname is not None:
+            with open(fname, 'w') as f:
+                f.write(s)
+                f.write("\n")
+        return s
@@ -0,0 +1,164 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Parsing a P4Info file in protobuf text format is slow for large
+# programs, and base_test.py and p4runtime_shell_utils.py used to do it
+# in every test, and again for every SetForwardingPipelineConfig.
+#
+# load_p4info() parses each file at most once per process.  It also
+# stores the parsed message in binary protobuf format on disk, together
+# with the index of unique name suffixes used by get_obj(), so that
+# later runs do not have to parse the text file at all.  Cache entries
+# are keyed by a hash of the file contents, so editing or recompiling
+# the P4 program never returns stale data.
+#
+# The P4Info messages returned are shared by all callers, and must not
+# be modified.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from p4.config.v1 import p4info_pb2
+import google.protobuf.text_format
+
+# The P4Info object types for which get_obj() accepts any unique suffix
+# of the object name.
+P4INFO_OBJ_TYPES = ["tables", "action_profiles", "actions", "counters",
+                    "direct_counters", "controller_packet_metadata",
+                    "digests", "registers", "meters", "direct_meters"]
+
+# Change this whenever the format of the files written in the cache
+# directory changes.
+CACHE_FORMAT_VERSION = 1
+
+_lock = threading.Lock()
+# content hash -> (P4Info, suffix index)
+_mem_cache = {}
+# id(P4Info) -> suffix index, for the P4Info objects in _mem_cache
+_index_by_id = {}
+
+
+def cache_dir():
+    d = os.environ.get("P4INFO_CACHE_DIR")
+    if d is None:
+        d = os.path.join(os.path.expanduser("~"), ".cache", "p4info")
+    return d
+
+
+def content_hash(data):
+    h = hashlib.sha256()
+    h.update(("p4info-cache-v%d %s\n" % (CACHE_FORMAT_VERSION,
+                                         ",".join(P4INFO_OBJ_TYPES))
+              ).encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+def make_suffix_index(p4info_data):
+    """Return a list of (obj_type, suffix, position) tuples, one for
+    each name suffix that identifies exactly one object among the
+    P4Info objects of type obj_type, e.g. ('tables', 'ipv4_lpm', 0)
+    for the first table, named 'MyIngress.ipv4_lpm'."""
+    positions = {}
+    duplicates = set()
+    for obj_type in P4INFO_OBJ_TYPES:
+        for pos, obj in enumerate(getattr(p4info_data, obj_type)):
+            suffix = None
+            for s in reversed(obj.preamble.name.split(".")):
+                suffix = s if suffix is None else s + "." + suffix
+                key = (obj_type, suffix)
+                if key in positions:
+                    duplicates.add(key)
+                positions[key] = pos
+    return [(obj_type, suffix, pos)
+            for (obj_type, suffix), pos in positions.items()
+            if (obj_type, suffix) not in duplicates]
+
+
+def make_obj_map(p4info_data):
+    """Return a dict mapping every (obj_type, suffix) key of the suffix
+    index of p4info_data to the corresponding P4Info object.  The index
+    is not recomputed if p4info_data was returned by load_p4info()."""
+    index = _index_by_id.get(id(p4info_data))
+    if index is None:
+        index = make_suffix_index(p4info_data)
+    obj_map = {}
+    for obj_type, suffix, pos in index:
+        obj_map[(obj_type, suffix)] = getattr(p4info_data, obj_type)[pos]
+    return obj_map
+
+
+def _read_disk_cache(path_prefix):
+    try:
+        with open(path_prefix + ".pb", "rb") as f:
+            data = f.read()
+        with open(path_prefix + ".json", "r") as f:
+            index = [tuple(x) for x in json.load(f)]
+    except (OSError, ValueError):
+        return None
+    p4info_data = p4info_pb2.P4Info()
+    try:
+        p4info_data.ParseFromString(data)
+    except Exception as e:
+        logging.warning("Ignoring corrupt P4Info cache file %s.pb: %s"
+                        "" % (path_prefix, e))
+        return None
+    return p4info_data, index
+
+
+def _write_disk_cache(path_prefix, p4info_data, index):
+    # Write to temporary files first, so that a concurrent reader never
+    # sees a partially written file.
+    tmp_suffix = ".tmp%d" % (os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path_prefix), exist_ok=True)
+        with open(path_prefix + ".pb" + tmp_suffix, "wb") as f:
+            f.write(p4info_data.SerializeToString())
+        with open(path_prefix + ".json" + tmp_suffix, "w") as f:
+            json.dump(index, f)
+        os.replace(path_prefix + ".pb" + tmp_suffix, path_prefix + ".pb")
+        os.replace(path_prefix + ".json" + tmp_suffix, path_prefix + ".json")
+    except OSError as e:
+        logging.debug("Could not write P4Info cache %s: %s"
+                      "" % (path_prefix, e))
+
+
+def load_p4info(p4info_txt_fname, use_disk_cache=True):
+    """Return a tuple (p4info, suffix_index) for the P4Info file in
+    protobuf text format named p4info_txt_fname.  See the comments at
+    the beginning of this file."""
+    with open(p4info_txt_fname, "rb") as fin:
+        data = fin.read()
+    key = content_hash(data)
+    with _lock:
+        entry = _mem_cache.get(key)
+        if entry is not None:
+            return entry
+        entry = None
+        path_prefix = os.path.join(cache_dir(), key)
+        if use_disk_cache:
+            entry = _read_disk_cache(path_prefix)
+        if entry is None:
+            logging.debug("Parsing P4Info text file %s" % (p4info_txt_fname))
+            p4info_data = p4info_pb2.P4Info()
+            google.protobuf.text_format.Merge(data, p4info_data)
+            entry = (p4info_data, make_suffix_index(p4info_data))
+            if use_disk_cache:
+                _write_disk_cache(path_prefix, entry[0], entry[1])
+        _mem_cache[key] = entry
+        _index_by_id[id(entry[0])] = entry[1]
+        return entry
@@ -0,0 +1,328 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The helpers in base_test.py and p4runtime_shell_utils.py used to find
+# match fields, action parameters and controller packet metadata fields
+# by scanning the P4Info message for every table entry or packet they
+# built.  P4InfoIndex does all of those lookups once, when the P4Info
+# is loaded, and keeps the results in dicts keyed by object id.
+#
+# It also contains encoders and decoders of controller packet metadata
+# and digests that are compiled once from such a layout.
+
+from array import array
+from collections import namedtuple
+
+from p4.v1 import p4runtime_pb2
+
+
+class TableInfo(object):
+    __slots__ = ('id', 'name', 'match_fields', 'match_fields_by_id')
+
+    def __init__(self, table):
+        self.id = table.preamble.id
+        self.name = table.preamble.name
+        # match field name -> p4info MatchField message
+        self.match_fields = {}
+        # match field id -> p4info MatchField message
+        self.match_fields_by_id = {}
+        for mf in table.match_fields:
+            self.match_fields[mf.name] = mf
+            self.match_fields_by_id[mf.id] = mf
+
+
+class ActionInfo(object):
+    __slots__ = ('id', 'name', 'params', 'params_by_id')
+
+    def __init__(self, action):
+        self.id = action.preamble.id
+        self.name = action.preamble.name
+        # param name -> p4info Action.Param message
+        self.params = {}
+        # param id -> p4info Action.Param message
+        self.params_by_id = {}
+        for p in action.params:
+            self.params[p.name] = p
+            self.params_by_id[p.id] = p
+
+
+class PacketMetadataInfo(object):
+    """The layout of one controller_packet_metadata header, such as
+    packet_in or packet_out.  by_name and by_id map the metadata field
+    name, or id, to a dict with keys 'id', 'name' and 'bitwidth', as
+    returned by the controller_packet_metadata_dict_key_name and
+    controller_packet_metadata_dict_key_id helpers.  Callers must not
+    modify them."""
+    __slots__ = ('id', 'name', 'fields', 'by_name', 'by_id')
+
+    def __init__(self, cpm):
+        self.id = cpm.preamble.id
+        self.name = cpm.preamble.name
+        # One dict per metadata field, in P4Info order
+        self.fields = []
+        self.by_name = {}
+        self.by_id = {}
+        for md in cpm.metadata:
+            d = {'id': md.id, 'name': md.name, 'bitwidth': md.bitwidth}
+            self.fields.append(d)
+            self.by_name[md.name] = d
+            self.by_id[md.id] = d
+
+
+class DigestInfo(object):
+    """The layout of the data of one digest.  'kind' is the type of the
+    digested data: 'struct' (the usual case), 'tuple' or 'bitstring'.
+    'fields' has one dict with keys 'name', 'bitwidth' and 'signed'
+    (True for an int<W>) per member of the struct or tuple, or a single
+    one for a bitstring.  Tuple members are named f0, f1, ...  Other
+    types, e.g. structs nested in the struct, are not supported, and
+    leave 'kind' and 'fields' None."""
+    __slots__ = ('id', 'name', 'kind', 'fields')
+
+    def __init__(self, digest, type_info):
+        self.id = digest.preamble.id
+        self.name = digest.preamble.name
+        self.kind = None
+        self.fields = None
+        type_spec = digest.type_spec
+        kind = type_spec.WhichOneof('type_spec')
+        if kind == 'bitstring':
+            members = [(digest.preamble.name.split(".")[-1], type_spec)]
+        elif kind == 'struct':
+            struct = type_info.structs.get(type_spec.struct.name)
+            if struct is None:
+                return
+            members = [(m.name, m.type_spec) for m in struct.members]
+        elif kind == 'tuple':
+            members = [("f%d" % (i), m)
+                       for i, m in enumerate(type_spec.tuple.members)]
+        else:
+            return
+        fields = []
+        for name, member_spec in members:
+            if member_spec.WhichOneof('type_spec') != 'bitstring':
+                return
+            bitstring = member_spec.bitstring
+            width_kind = bitstring.WhichOneof('type_spec')
+            fields.append({'name': name,
+                           'bitwidth': getattr(bitstring, width_kind).bitwidth
+                           if width_kind in ('bit', 'int') else None,
+                           'signed': width_kind == 'int'})
+        self.kind = kind
+        self.fields = fields
+
+
+class P4InfoIndex(object):
+    def __init__(self, p4info_data):
+        # table id -> TableInfo
+        self.tables = {}
+        # action id -> ActionInfo
+        self.actions = {}
+        # controller_packet_metadata id -> PacketMetadataInfo
+        self.packet_metadata = {}
+        # digest id -> DigestInfo
+        self.digests = {}
+        for table in p4info_data.tables:
+            self.tables[table.preamble.id] = TableInfo(table)
+        for action in p4info_data.actions:
+            self.actions[action.preamble.id] = ActionInfo(action)
+        for cpm in p4info_data.controller_packet_metadata:
+            self.packet_metadata[cpm.preamble.id] = PacketMetadataInfo(cpm)
+        for digest in p4info_data.digests:
+            self.digests[digest.preamble.id] = DigestInfo(
+                digest, p4info_data.type_info)
+
+
+class P4InfoObjMap(dict):
+    """The dict returned by make_p4info_obj_map in
+    p4runtime_shell_utils.py, which also carries the P4InfoIndex of the
+    same P4Info message in its 'index' attribute."""
+
+    def __init__(self, obj_map, index):
+        super(P4InfoObjMap, self).__init__(obj_map)
+        self.index = index
+
+
+class PacketOutEncoder(object):
+    """Builds StreamMessageRequest messages containing a PacketOut with
+    the metadata fields named in 'field_names', in that order, of the
+    controller packet metadata 'layout' (a PacketMetadataInfo, normally
+    the one of the packet_out header).  All fields of the layout are
+    used if 'field_names' is None.
+
+    Metadata values are encoded with the full width of the field, like
+    P4RuntimeTest.encode_packet_out_metadata does.  They can also be
+    given as bytes already in that format."""
+
+    def __init__(self, layout, field_names=None):
+        if field_names is None:
+            field_names = [f['name'] for f in layout.fields]
+        self.field_names = list(field_names)
+        self.bytewidths = []
+        # Message with the metadata ids already set, copied by encode()
+        self._template = p4runtime_pb2.StreamMessageRequest()
+        for name in self.field_names:
+            f = layout.by_name[name]
+            self.bytewidths.append((f['bitwidth'] + 7) // 8)
+            md = self._template.packet.metadata.add()
+            md.metadata_id = f['id']
+
+    def encode(self, payload, values):
+        """Return a StreamMessageRequest with a PacketOut containing
+        'payload' and the metadata values in the sequence 'values'.
+        Raises ValueError if there is not one value per field."""
+        if len(values) != len(self.bytewidths):
+            raise ValueError("%d metadata values given for %d fields"
+                             "" % (len(values), len(self.bytewidths)))
+        req = p4runtime_pb2.StreamMessageRequest()
+        req.CopyFrom(self._template)
+        packet = req.packet
+        packet.payload = payload
+        for md, bytewidth, v in zip(packet.metadata, self.bytewidths,
+                                    values):
+            if type(v) is bytes:
+                md.value = v
+            else:
+                md.value = v.to_bytes(bytewidth, byteorder='big')
+        return req
+
+
+class PacketInDecoder(object):
+    """Decodes the metadata of PacketIn messages with the controller
+    packet metadata 'layout' (a PacketMetadataInfo, normally the one of
+    the packet_in header).
+
+    decode() returns one namedtuple per packet, with one attribute per
+    metadata field, in P4Info order, plus 'payload'.  decode_batch()
+    returns the same data for many packets as columns: a dict mapping
+    each field name to an array('Q') of values (a list for fields wider
+    than 64 bits), and 'payload' to a list of payloads.  A field
+    missing from a packet is None in decode(), and 0 in
+    decode_batch().  Raises ValueError if a metadata field is named
+    'payload'."""
+
+    def __init__(self, layout):
+        self.field_names = [f['name'] for f in layout.fields]
+        if 'payload' in self.field_names:
+            raise ValueError("PacketIn metadata field name 'payload' clashes"
+                             " with the payload of decoded packets")
+        self.bitwidths = [f['bitwidth'] for f in layout.fields]
+        # metadata id -> position of the field in self.field_names
+        self._positions = {}
+        for i, f in enumerate(layout.fields):
+            self._positions[f['id']] = i
+        # rename=True, in case a field name is not a valid identifier
+        self.record_type = namedtuple('PacketInRecord',
+                                      self.field_names + ['payload'],
+                                      rename=True)
+
+    def _position(self, metadata_id):
+        pos = self._positions.get(metadata_id)
+        if pos is None:
+            raise ValueError("PacketIn has unknown metadata id %d"
+                             "" % (metadata_id))
+        return pos
+
+    def decode(self, packet):
+        values = [None] * (len(self.field_names) + 1)
+        for md in packet.metadata:
+            values[self._position(md.metadata_id)] = int.from_bytes(
+                md.value, byteorder='big')
+        values[-1] = packet.payload
+        return self.record_type._make(values)
+
+    def decode_batch(self, packets):
+        columns = []
+        for bitwidth in self.bitwidths:
+            columns.append(array('Q') if bitwidth <= 64 else [])
+        payloads = []
+        num_fields = len(self.field_names)
+        from_bytes = int.from_bytes
+        for packet in packets:
+            row = [0] * num_fields
+            for md in packet.metadata:
+                row[self._position(md.metadata_id)] = from_bytes(
+                    md.value, byteorder='big')
+            for column, v in zip(columns, row):
+                column.append(v)
+            payloads.append(packet.payload)
+        ret = dict(zip(self.field_names, columns))
+        ret['payload'] = payloads
+        return ret
+
+
+class DigestDecoder(object):
+    """Decodes the DigestList messages of the digest with layout
+    'layout' (a DigestInfo).
+
+    decode() returns one namedtuple per digest in a DigestList, with
+    one attribute per field.  decode_batch() returns the digests of
+    many DigestLists as columns: a dict mapping each field name to an
+    array('Q') of values, array('q') for signed fields (a list for
+    fields wider than 64 bits, or of variable width).  Signed (int<W>)
+    fields are sign extended from their bitwidth."""
+
+    def __init__(self, layout):
+        if layout.fields is None:
+            raise ValueError("Digest %s has a type that is not supported"
+                             "" % (layout.name))
+        self.digest_id = layout.id
+        self.name = layout.name
+        self.field_names = [f['name'] for f in layout.fields]
+        self.bitwidths = [f['bitwidth'] for f in layout.fields]
+        self.signed = [f['signed'] for f in layout.fields]
+        # (position, bitwidth) of the signed fields
+        self._signed = [(i, f['bitwidth'])
+                        for i, f in enumerate(layout.fields)
+                        if f['signed'] and f['bitwidth']]
+        self._kind = layout.kind
+        self.record_type = namedtuple('DigestRecord', self.field_names,
+                                      rename=True)
+
+    def _values(self, data):
+        from_bytes = int.from_bytes
+        if self._kind == 'bitstring':
+            values = [from_bytes(data.bitstring, byteorder='big')]
+        else:
+            if self._kind == 'struct':
+                members = data.struct.members
+            else:
+                members = data.tuple.members
+            values = [from_bytes(m.bitstring, byteorder='big')
+                      for m in members]
+        for i, bitwidth in self._signed:
+            v = values[i]
+            if v >> (bitwidth - 1):
+                values[i] = v - (1 << bitwidth)
+        return values
+
+    def decode(self, digest_list):
+        assert digest_list.digest_id == self.digest_id
+        make = self.record_type._make
+        return [make(self._values(data)) for data in digest_list.data]
+
+    def decode_batch(self, digest_lists):
+        columns = []
+        for bitwidth, signed in zip(self.bitwidths, self.signed):
+            if bitwidth is not None and bitwidth <= 64:
+                columns.append(array('q' if signed else 'Q'))
+            else:
+                columns.append([])
+        values = self._values
+        for digest_list in digest_lists:
+            assert digest_list.digest_id == self.digest_id
+            for data in digest_list.data:
+                for column, v in zip(columns, values(data)):
+                    column.append(v)
+        return dict(zip(self.field_names, columns))
@@ -1,12 +1,24 @@
 import logging
+import re
+import socket
 from collections import Counter
 
 from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
 from google.rpc import code_pb2
 import google.protobuf.text_format
 import p4runtime_sh.p4runtime as p4rt
 import p4runtime_sh.shell as sh
 
+from bulk_encode import (stringify_many, pack_fixed_width,
+                         unpack_fixed_width, ipv4s_to_binary, ipv4s_to_int,
+                         ipv6s_to_binary, ipv6s_to_int, macs_to_binary,
+                         macs_to_int)
+import entity_dump
+import p4info_cache
+import table_sync
+from p4info_index import P4InfoIndex, P4InfoObjMap, PacketInDecoder
+
 
 def as_list_of_dicts(exc):
     lst = []
@@ -48,7 +60,7 @@ def ipv6_to_int(addr):
     """Take an argument 'addr' containing an IPv6 address written in
     standard syntax, e.g. '2001:0db8::3210', and convert it to an
     integer."""
-    bytes_ = socket.inet_pton(socket.AF_INET6, '2001:0db8::3210')
+    bytes_ = socket.inet_pton(socket.AF_INET6, addr)
     # Note: The bytes() call below will throw exception if any
     # elements of bytes_ is outside of the range [0, 255]], so no need
     # to add a separate check for that here.
@@ -112,9 +124,9 @@ def assertP4RuntimeError(self, code=None, msg_regexp=None):
     return context
 
 def read_p4info_txt_file(p4info_txt_fname):
-    p4info_data = p4info_pb2.P4Info()
-    with open(p4info_txt_fname, "rb") as fin:
-        google.protobuf.text_format.Merge(fin.read(), p4info_data)
+    # The returned message is shared with other callers, see
+    # p4info_cache.py
+    p4info_data, _ = p4info_cache.load_p4info(p4info_txt_fname)
     return p4info_data
 
 def serializable_enum_dict(p4info_data, name):
@@ -132,14 +144,40 @@ def serializable_enum_dict(p4info_data, name):
                   "" % (name, name_to_int, int_to_name))
     return name_to_int, int_to_name
 
+def iter_table_normal_entries(table_name_str, filter_fn=None,
+                              project_fn=None):
+    """Generator yielding the normal entries of table 'table_name_str',
+    as sh.TableEntry objects, as the ReadResponse messages containing
+    them arrive.  Only the entries for which filter_fn(te) is true are
+    yielded, if 'filter_fn' is not None, and each one is replaced by
+    project_fn(te) if 'project_fn' is not None."""
+    for te in sh.TableEntry(table_name_str).read():
+        if filter_fn is not None and not filter_fn(te):
+            continue
+        if project_fn is not None:
+            te = project_fn(te)
+        yield te
+
 def read_table_normal_entries(table_name_str):
-    tes = []
-    def do_save_te(te):
-        tes.append(te)
-    sh.TableEntry(table_name_str).read(lambda te: do_save_te(te))
-    return tes
+    if _shadow_cache is not None:
+        return _shadow_cache.read_normal_entries(table_name_str)
+    return list(iter_table_normal_entries(table_name_str))
+
+def dump_table_to_file(table_name_str, fname, fmt=None, filter_fn=None,
+                       project_fn=None):
+    """Write the entries of iter_table_normal_entries() to the file
+    named 'fname', see entity_dump.dump_entries().  Returns the number
+    of entries written."""
+    return entity_dump.dump_entries(
+        iter_table_normal_entries(table_name_str, filter_fn, project_fn),
+        fname, fmt)
 
 def read_table_default_entry(table_name_str):
+    if _shadow_cache is not None:
+        return _shadow_cache.read_default_entry(table_name_str)
+    return _read_table_default_entry(table_name_str)
+
+def _read_table_default_entry(table_name_str):
     te = sh.TableEntry(table_name_str)
     te.is_default = True
     for x in te.read():
@@ -159,25 +197,270 @@ def dump_table(table_name_str):
     logging.info(default_entry)
 
 
+def _shell_table_entry(table_name_str, msg):
+    # The same conversion as sh.TableEntry.read() does for the entries
+    # it returns.
+    te = sh.TableEntry(table_name_str)
+    te._from_msg(msg)
+    return te
+
+def _canonical_table_entry(msg):
+    return table_sync.canonical_table_entry(msg).SerializeToString(
+        deterministic=True)
+
+def _table_key(table_name_str):
+    # The full P4Info name of table 'table_name_str', which may be any
+    # suffix uniquely identifying it, so that e.g. 'ipv4_lpm' and
+    # 'MyIngress.ipv4_lpm' share the same cached contents.
+    obj = sh.context.get_obj(sh.P4Type.table, table_name_str)
+    if obj is None:
+        return table_name_str
+    return obj.preamble.name
+
+class ShadowTableCache(object):
+    """A local copy of the contents of tables, kept up to date by the
+    writes made with insert_table_entry, modify_table_entry and
+    delete_table_entry, so that read_table_normal_entries,
+    read_table_default_entry and dump_table do not read the switch
+    again.  Each table is read from the switch in full the first time
+    it is used.
+
+    Tables are cached by their full P4Info name, whatever name is used
+    to refer to them, and 'hits' and 'misses' count the reads of the
+    helpers above that were, or were not, answered from the cache.
+
+    It is only correct if all writes to the cached tables go through
+    those helpers: entries written otherwise, or removed by the switch
+    itself, e.g. on idle timeout, are not seen.  verify() compares the
+    cache with the switch, which is useful at the end of a test.
+
+    Enable it with enable_shadow_cache()."""
+
+    def __init__(self):
+        # full table name -> dict mapping entry_key() of each normal
+        # entry to its TableEntry message
+        self._entries = {}
+        # full table name -> default entry TableEntry message
+        self._defaults = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_key(msg):
+        return table_sync.entry_key(table_sync.canonical_table_entry(msg))
+
+    def _load(self, table_name_str):
+        entries = {}
+        for te in iter_table_normal_entries(table_name_str):
+            msg = p4runtime_pb2.TableEntry()
+            msg.CopyFrom(te.msg())
+            entries[self.entry_key(msg)] = msg
+        return entries
+
+    def _table(self, table_name_str, count=False):
+        key = _table_key(table_name_str)
+        entries = self._entries.get(key)
+        if entries is None:
+            if count:
+                self.misses += 1
+            entries = self._load(key)
+            self._entries[key] = entries
+        elif count:
+            self.hits += 1
+        return entries
+
+    def invalidate(self, table_name_str=None):
+        """Forget the contents of table 'table_name_str', or of all
+        tables if it is None, so that they are read again."""
+        if table_name_str is None:
+            self._entries.clear()
+            self._defaults.clear()
+        else:
+            key = _table_key(table_name_str)
+            self._entries.pop(key, None)
+            self._defaults.pop(key, None)
+
+    def _copy(self, te):
+        msg = p4runtime_pb2.TableEntry()
+        msg.CopyFrom(te.msg())
+        return msg
+
+    def insert(self, te):
+        entries = self._table(te.name)
+        te.insert()
+        msg = self._copy(te)
+        entries[self.entry_key(msg)] = msg
+
+    def modify(self, te):
+        if te.is_default:
+            te.modify()
+            self._defaults[_table_key(te.name)] = self._copy(te)
+            return
+        entries = self._table(te.name)
+        te.modify()
+        msg = self._copy(te)
+        entries[self.entry_key(msg)] = msg
+
+    def delete(self, te):
+        entries = self._table(te.name)
+        te.delete()
+        entries.pop(self.entry_key(te.msg()), None)
+
+    def apply(self, table_name_str, update_type, msg):
+        """Update the cache for an update of type 'update_type' of the
+        TableEntry 'msg' written to the switch without the methods
+        above."""
+        entries = self._entries.get(_table_key(table_name_str))
+        if entries is None:
+            return
+        key = self.entry_key(msg)
+        if update_type == p4runtime_pb2.Update.DELETE:
+            entries.pop(key, None)
+        else:
+            copy = p4runtime_pb2.TableEntry()
+            copy.CopyFrom(msg)
+            entries[key] = copy
+
+    def read_normal_entries(self, table_name_str):
+        return [_shell_table_entry(table_name_str, msg)
+                for msg in self._table(table_name_str, True).values()]
+
+    def read_default_entry(self, table_name_str):
+        key = _table_key(table_name_str)
+        msg = self._defaults.get(key)
+        if msg is None:
+            self.misses += 1
+            msg = self._copy(_read_table_default_entry(table_name_str))
+            self._defaults[key] = msg
+        else:
+            self.hits += 1
+        return _shell_table_entry(table_name_str, msg)
+
+    def lookup(self, te):
+        """Return the cached entry with the same match key and priority
+        as the sh.TableEntry 'te', as a sh.TableEntry, or None."""
+        msg = self._table(te.name, True).get(self.entry_key(te.msg()))
+        if msg is None:
+            return None
+        return _shell_table_entry(te.name, msg)
+
+    def verify(self, table_name_str=None):
+        """Read table 'table_name_str', or all cached tables if it is
+        None, from the switch, and compare their normal entries with
+        the cache, ignoring counter and meter data.  Returns a dict
+        mapping the full name of each table with differences to a dict
+        with lists of TableEntry messages: 'missing' for entries in the
+        cache only, 'unexpected' for entries on the switch only, and
+        'different' for (cached, switch) pairs with the same key.  An
+        empty dict means that the cache is correct."""
+        if table_name_str is None:
+            table_names = list(self._entries)
+        else:
+            table_names = [_table_key(table_name_str)]
+        ret = {}
+        for name in table_names:
+            cached = self._table(name)
+            device = self._load(name)
+            diff = {'missing': [], 'unexpected': [], 'different': []}
+            for key, msg in cached.items():
+                dev_msg = device.get(key)
+                if dev_msg is None:
+                    diff['missing'].append(msg)
+                elif (_canonical_table_entry(msg) !=
+                      _canonical_table_entry(dev_msg)):
+                    diff['different'].append((msg, dev_msg))
+            for key, dev_msg in device.items():
+                if key not in cached:
+                    diff['unexpected'].append(dev_msg)
+            if any(diff.values()):
+                ret[name] = diff
+        return ret
+
+_shadow_cache = None
+
+def enable_shadow_cache():
+    """Make the read helpers of this module use a ShadowTableCache, and
+    return it."""
+    global _shadow_cache
+    if _shadow_cache is None:
+        _shadow_cache = ShadowTableCache()
+    return _shadow_cache
+
+def disable_shadow_cache():
+    global _shadow_cache
+    _shadow_cache = None
+
+def shadow_cache():
+    """Return the ShadowTableCache in use, or None."""
+    return _shadow_cache
+
+# Write the sh.TableEntry 'te' to the switch, keeping the shadow cache,
+# if enabled, up to date.
+def insert_table_entry(te):
+    if _shadow_cache is not None:
+        _shadow_cache.insert(te)
+    else:
+        te.insert()
+
+def modify_table_entry(te):
+    if _shadow_cache is not None:
+        _shadow_cache.modify(te)
+    else:
+        te.modify()
+
+def delete_table_entry(te):
+    if _shadow_cache is not None:
+        _shadow_cache.delete(te)
+    else:
+        te.delete()
+
+def sync_table(table_name_str, desired_entries, delete_extra=True,
+               max_updates=1000):
+    """Make the normal entries of table 'table_name_str' equal to
+    'desired_entries', sh.TableEntry objects or TableEntry messages,
+    with as few updates as possible, see table_sync.diff_table_entries.
+    Updates are sent in WriteRequests of at most 'max_updates' updates,
+    deletions first, and are applied to the shadow cache if enabled.
+    If a write fails, the table is removed from the shadow cache, so
+    that it is read again from the switch.
+    Returns a dict with the number of updates of each type, and of
+    entries that were already as desired."""
+    desired = [te if isinstance(te, p4runtime_pb2.TableEntry) else te.msg()
+               for te in desired_entries]
+    current = [te.msg() for te in iter_table_normal_entries(table_name_str)]
+    diff = table_sync.diff_table_entries(desired, current, delete_extra)
+    write = p4rt.parse_p4runtime_write_error(sh.client.write)
+    for update_type, entries in [(p4runtime_pb2.Update.DELETE, diff.deletes),
+                                 (p4runtime_pb2.Update.MODIFY, diff.modifies),
+                                 (p4runtime_pb2.Update.INSERT, diff.inserts)]:
+        for i in range(0, len(entries), max_updates):
+            req = p4runtime_pb2.WriteRequest()
+            for msg in entries[i:i + max_updates]:
+                update = req.updates.add()
+                update.type = update_type
+                update.entity.table_entry.CopyFrom(msg)
+            try:
+                write(req)
+            except Exception:
+                # Some of the updates may have been applied.
+                if _shadow_cache is not None:
+                    _shadow_cache.invalidate(table_name_str)
+                raise
+            if _shadow_cache is not None:
+                for msg in entries[i:i + max_updates]:
+                    _shadow_cache.apply(table_name_str, update_type, msg)
+    return {'insert': len(diff.inserts), 'modify': len(diff.modifies),
+            'delete': len(diff.deletes), 'unchanged': diff.unchanged}
+
+
 # In order to make writing tests easier, we accept any suffix that uniquely
 # identifies the object among p4info objects of the same type.
+#
+# The returned dict also holds a P4InfoIndex of p4info_data in its
+# 'index' attribute, used by the helpers below.
 def make_p4info_obj_map(p4info_data):
-    p4info_obj_map = {}
-    suffix_count = Counter()
-    for obj_type in ["tables", "action_profiles", "actions", "counters",
-                     "direct_counters", "controller_packet_metadata"]:
-        for obj in getattr(p4info_data, obj_type):
-            pre = obj.preamble
-            suffix = None
-            for s in reversed(pre.name.split(".")):
-                suffix = s if suffix is None else s + "." + suffix
-                key = (obj_type, suffix)
-                p4info_obj_map[key] = obj
-                suffix_count[key] += 1
-    for key, c in list(suffix_count.items()):
-        if c > 1:
-            del p4info_obj_map[key]
-    return p4info_obj_map
+    return P4InfoObjMap(p4info_cache.make_obj_map(p4info_data),
+                        P4InfoIndex(p4info_data))
 
 def get_obj(p4info_obj_map, obj_type, name):
     key = (obj_type, name)
@@ -192,12 +475,24 @@ def get_obj_id(p4info_obj_map, obj_type, name):
 def controller_packet_metadata_dict_key_id(p4info_obj_map, name):
     cpm_info = get_obj(p4info_obj_map, "controller_packet_metadata", name)
     assert cpm_info != None
+    index = getattr(p4info_obj_map, 'index', None)
+    if index is not None:
+        # Shared dict, must not be modified by the caller
+        return index.packet_metadata[cpm_info.preamble.id].by_id
     ret = {}
     for md in cpm_info.metadata:
         id = md.id
         ret[md.id] = {'id': md.id, 'name': md.name, 'bitwidth': md.bitwidth}
     return ret
 
+def make_packet_in_decoder(p4info_obj_map, name="packet_in"):
+    """Return a PacketInDecoder for the controller packet metadata
+    'name'.  p4info_obj_map must be returned by make_p4info_obj_map."""
+    cpm_info = get_obj(p4info_obj_map, "controller_packet_metadata", name)
+    assert cpm_info != None
+    return PacketInDecoder(
+        p4info_obj_map.index.packet_metadata[cpm_info.preamble.id])
+
 def decode_packet_in_metadata(pktin_info, packet):
     pktin_field_to_val = {}
     for md in packet.metadata:
@@ -0,0 +1,145 @@
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Comparison of sets of table entries, used by the sync_table helpers
+# of base_test.py and p4runtime_shell_utils.py to compute the smallest
+# set of INSERT, MODIFY and DELETE updates that make the entries of a
+# table on the switch equal to a desired set of entries.
+#
+# Entries are compared in a canonical form: match fields sorted by
+# field id, byte strings of match fields and action parameters without
+# leading zero bytes, as in the P4Runtime specification, and without
+# the counter, meter and idle time data that the switch returns in
+# read responses.
+
+from collections import namedtuple
+
+from p4.v1 import p4runtime_pb2
+
+# The result of diff_table_entries: lists of TableEntry messages to
+# insert, modify and delete, and the number of desired entries that are
+# already on the switch as desired.
+TableDiff = namedtuple('TableDiff',
+                       ['inserts', 'modifies', 'deletes', 'unchanged'])
+
+
+def _strip(b):
+    return b.lstrip(b'\x00') or b'\x00'
+
+
+def _canonical_action(action):
+    params = sorted(action.params, key=lambda p: p.param_id)
+    action.ClearField('params')
+    for p in params:
+        action.params.add(param_id=p.param_id, value=_strip(p.value))
+
+
+def _canonical_match(match, ret):
+    # Append the FieldMatch messages of 'match' in canonical form to the
+    # repeated field 'ret'.
+    for mf in sorted(match, key=lambda m: m.field_id):
+        c = ret.add()
+        c.CopyFrom(mf)
+        kind = mf.WhichOneof('field_match_type')
+        if kind == 'exact':
+            c.exact.value = _strip(mf.exact.value)
+        elif kind == 'lpm':
+            c.lpm.value = _strip(mf.lpm.value)
+        elif kind == 'ternary':
+            c.ternary.value = _strip(mf.ternary.value)
+            c.ternary.mask = _strip(mf.ternary.mask)
+        elif kind == 'range':
+            c.range.low = _strip(mf.range.low)
+            c.range.high = _strip(mf.range.high)
+        elif kind == 'optional':
+            c.optional.value = _strip(mf.optional.value)
+
+
+def canonical_table_entry(msg):
+    """Return a copy of the TableEntry 'msg' in canonical form."""
+    ret = p4runtime_pb2.TableEntry()
+    ret.CopyFrom(msg)
+    ret.ClearField('counter_data')
+    ret.ClearField('meter_counter_data')
+    ret.ClearField('time_since_last_hit')
+    ret.ClearField('match')
+    _canonical_match(msg.match, ret.match)
+    kind = ret.action.WhichOneof('type')
+    if kind == 'action':
+        _canonical_action(ret.action.action)
+    elif kind == 'action_profile_action_set':
+        for a in ret.action.action_profile_action_set.action_profile_actions:
+            _canonical_action(a.action)
+    return ret
+
+
+def entry_key(canonical):
+    """Return the key identifying the entry 'canonical', returned by
+    canonical_table_entry(), in its table: its serialized match fields
+    and its priority."""
+    match_only = p4runtime_pb2.TableEntry()
+    match_only.match.extend(canonical.match)
+    return (match_only.SerializeToString(deterministic=True),
+            canonical.priority)
+
+
+def match_key(msg):
+    """Return entry_key(canonical_table_entry(msg)) for the TableEntry
+    'msg', without copying its action."""
+    match_only = p4runtime_pb2.TableEntry()
+    _canonical_match(msg.match, match_only.match)
+    return (match_only.SerializeToString(deterministic=True), msg.priority)
+
+
+def index_table_entries(entries):
+    """Return a dict mapping the key of each TableEntry of the iterable
+    'entries' to a tuple (entry, serialized canonical entry)."""
+    ret = {}
+    for msg in entries:
+        c = canonical_table_entry(msg)
+        ret[entry_key(c)] = (msg, c.SerializeToString(deterministic=True))
+    return ret
+
+
+def diff_table_entries(desired, current, delete_extra=True):
+    """Compare the TableEntry messages of the iterables 'desired' and
+    'current' (normally read from the switch), and return a TableDiff
+    with the entries of 'desired' to insert, the entries of 'desired'
+    to modify, and the entries of 'current' to delete, which is always
+    empty if 'delete_extra' is False.  Raises ValueError if two desired
+    entries have the same match key and priority."""
+    current = index_table_entries(current)
+    inserts = []
+    modifies = []
+    unchanged = 0
+    seen = set()
+    for msg in desired:
+        assert not msg.is_default_action
+        c = canonical_table_entry(msg)
+        key = entry_key(c)
+        if key in seen:
+            raise ValueError("Duplicate desired entry:\n%s" % (msg))
+        seen.add(key)
+        cur = current.get(key)
+        if cur is None:
+            inserts.append(msg)
+        elif cur[1] != c.SerializeToString(deterministic=True):
+            modifies.append(msg)
+        else:
+            unchanged += 1
+    deletes = []
+    if delete_extra:
+        deletes = [msg for key, (msg, _) in current.items()
+                   if key not in seen]
+    return TableDiff(inserts, modifies, deletes, unchanged)
@@ -64,6 +64,10 @@ class DpdkSwitch(Switch):
         self.log_file = kwargs.get('log_file', None)
         self.pcap_dir = kwargs.get('pcap_dir', None)
         self.params = kwargs.get('params', {})
+        # Unix socket on which the DPDK program accepts runtime entries,
+        # see runtime_loader.py
+        self.control_socket = self.params.get(
+            'control_socket', "/tmp/{}-control.sock".format(name))
 
     @classmethod
     def setup(cls):
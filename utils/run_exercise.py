@@ -38,7 +38,8 @@ from mininet.cli import CLI
 from mininet.link import TCLink
 from mininet.net import Mininet
 from mininet.topo import Topo
-from dpdk_mininet import DpdkHost, DpdkSwitch
+from dpdk_mininet import SWITCH_START_TIMEOUT, DpdkHost, DpdkSwitch
+from runtime_loader import load_runtime_json
 
 
 class ExerciseTopo(Topo):
@@ -165,6 +166,7 @@ class ExerciseRunner:
         sleep(1)
 
         # some programming that must happen after the net has started
+        self.program_switches()
         self.program_hosts()
 
         # wait for that to finish. Not sure how to do this better
@@ -220,6 +222,40 @@ class ExerciseRunner:
                       switch = DpdkSwitch,
                       controller = None)
 
+    def program_switches(self):
+        """ Load the entries of the runtime_json file of each switch, if
+            any, into the switch. The optional switch properties 'target',
+            'grpc_addr', 'device_id', 'p4info' and 'control_socket' in the
+            topology json select how, see runtime_loader.py.
+        """
+        for sw_name, sw_dict in self.switches.items():
+            runtime_json = sw_dict.get('runtime_json')
+            if not runtime_json:
+                continue
+            if not os.path.isfile(runtime_json):
+                self.logger('Runtime json %s of %s not found, skipping.'
+                            % (runtime_json, sw_name))
+                continue
+            sw = self.net.get(sw_name)
+            self.logger('Loading runtime json %s into %s.'
+                        % (runtime_json, sw_name))
+            try:
+                stats = load_runtime_json(
+                    runtime_json,
+                    target=sw_dict.get('target'),
+                    grpc_addr=sw_dict.get('grpc_addr', 'localhost:50051'),
+                    device_id=sw_dict.get('device_id', 0),
+                    p4info_fname=sw_dict.get('p4info'),
+                    control_socket=sw.control_socket,
+                    connect_timeout=SWITCH_START_TIMEOUT,
+                    default_target='dpdk')
+            except Exception as e:
+                self.logger('Could not load runtime json %s into %s: %s'
+                            % (runtime_json, sw_name, e))
+                continue
+            self.logger('Loaded %d entries into %s in %.3f seconds.'
+                        % (stats['updates'], sw_name, stats['seconds']))
+
     def program_hosts(self):
         """ Execute any commands provided in the topology.json file on each Mininet host
         """
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Loads the runtime configuration named by the "runtime_json" property of
+# a switch in topology.json into the switch, when the network starts.
+#
+# The runtime JSON file has the format used by the P4 tutorial:
+#
+#   {
+#     "target": "bmv2",
+#     "p4info": "build/program.p4.p4info.txt",
+#     "table_entries": [
+#       {"table": "MyIngress.ipv4_lpm",
+#        "match": {"hdr.ipv4.dstAddr": ["10.0.1.1", 32]},
+#        "action_name": "MyIngress.ipv4_forward",
+#        "action_params": {"dstAddr": "08:00:00:00:01:11", "port": 1}},
+#       {"table": "MyIngress.ipv4_lpm", "default_action": true,
+#        "action_name": "MyIngress.drop", "action_params": {}},
+#       ...
+#     ],
+#     "multicast_group_entries": [
+#       {"multicast_group_id": 1,
+#        "replicas": [{"egress_port": 1, "instance": 1}, ...]},
+#       ...
+#     ],
+#     "clone_session_entries": [...]
+#   }
+#
+# The file is parsed incrementally: the entries of the arrays above are
+# decoded and sent one at a time, so a file with millions of entries is
+# never held in memory.  Entries are sent in batches:
+#
+# - to P4 targets (any "target" other than "dpdk") with P4Runtime Write
+#   RPCs of up to 'max_updates' updates each.  This needs the grpc and
+#   p4runtime Python packages, which are only imported then.
+# - to DPDK targets over a control channel: a Unix stream socket on
+#   which the DPDK program reads one JSON object per line, each being
+#   an entry of the file with an added "type" key, "table_entry",
+#   "multicast_group_entry" or "clone_session_entry".  Lines are
+#   written 'max_updates' at a time, and the last one is
+#   {"type": "end"}.
+
+import argparse
+import json
+import queue
+import socket
+import threading
+import time
+
+# A little less than the largest message gRPC servers accept by default.
+# Same value as DEFAULT_MAX_REQUEST_BYTES in testlib/grpc_channel.py,
+# which is the reference: this file is run without testlib on its path.
+DEFAULT_MAX_REQUEST_BYTES = 4 * 1024 * 1024 - 64 * 1024
+
+# Keys of the runtime JSON file whose value is an array of entries,
+# decoded one entry at a time, and the type of those entries.
+STREAMED_KEYS = {'table_entries': 'table_entry',
+                 'multicast_group_entries': 'multicast_group_entry',
+                 'clone_session_entries': 'clone_session_entry'}
+
+
+class _IncrementalReader(object):
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > 0:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        # Return the next non whitespace character, without consuming it
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError("Invalid runtime JSON: expected one of %r at"
+                             " offset %d, found %r" % (chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number may continue in the next chunk, even if what was
+            # decoded is valid, e.g. '1' of '1.5' or '1.' of '1.5e3':
+            # only trust it once it is followed by a delimiter.
+            if not isinstance(obj, (str, list, dict)) and \
+                    not self._delimited(end) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def _delimited(self, end):
+        return end < len(self.buf) and (self.buf[end] in ',]}' or
+                                        self.buf[end].isspace())
+
+
+def iter_runtime_json(fname, chunk_size=1 << 16):
+    """Generator parsing the runtime JSON file 'fname' incrementally.
+    It yields a tuple (entry_type, entry) for each entry of the arrays
+    of STREAMED_KEYS, and (key, value) for the other keys of the
+    top-level object, in file order."""
+    with open(fname, 'r') as f:
+        r = _IncrementalReader(f, chunk_size)
+        r.expect('{')
+        if r.peek() == '}':
+            return
+        while True:
+            key = r.value()
+            r.expect(':')
+            entry_type = STREAMED_KEYS.get(key)
+            if entry_type is not None and r.peek() == '[':
+                r.expect('[')
+                if r.peek() != ']':
+                    while True:
+                        yield entry_type, r.value()
+                        if r.expect(',]') == ']':
+                            break
+                else:
+                    r.expect(']')
+            else:
+                yield key, r.value()
+            if r.expect(',}') == '}':
+                return
+
+
+def encode_value(v):
+    """Return the P4Runtime encoding, with no leading zero bytes, of a
+    value of the runtime JSON file: an int, or a string containing an
+    int, an IPv4 address, an IPv6 address or a MAC address."""
+    if isinstance(v, str):
+        if v.count(':') == 5 and len(v) <= 17 and '::' not in v:
+            b = bytes(int(x, 16) for x in v.split(':'))
+        elif ':' in v:
+            b = socket.inet_pton(socket.AF_INET6, v)
+        elif v.count('.') == 3:
+            b = socket.inet_aton(v)
+        else:
+            v = int(v, 0)
+            b = v.to_bytes((v.bit_length() + 7) // 8, byteorder='big')
+    else:
+        b = v.to_bytes((v.bit_length() + 7) // 8, byteorder='big')
+    return b.lstrip(b'\x00') or b'\x00'
+
+
+class P4RuntimeLoader(object):
+    """Writes the entries of a runtime JSON file to a P4Runtime server,
+    in WriteRequests of at most 'max_updates' updates and about
+    'max_request_bytes' bytes, under the 4 MB that gRPC servers accept
+    by default.  The P4Info message is read from the file named
+    'p4info_fname'.  Raises TimeoutError if the server does not answer
+    the arbitration request within 'arbitration_timeout' seconds."""
+
+    def __init__(self, grpc_addr, device_id, p4info_fname,
+                 election_id=(0, 1), max_updates=1000,
+                 max_request_bytes=DEFAULT_MAX_REQUEST_BYTES,
+                 arbitration_timeout=10):
+        import grpc
+        from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+        from p4.config.v1 import p4info_pb2
+        import google.protobuf.text_format
+
+        self.pb = p4runtime_pb2
+        self.p4info_pb = p4info_pb2
+        self.device_id = device_id
+        self.election_id = election_id
+        self.max_updates = max_updates
+        self.max_request_bytes = max_request_bytes
+        # Size of the updates in self.req
+        self._req_bytes = 0
+        self.num_updates = 0
+        self.num_requests = 0
+
+        self.p4info = p4info_pb2.P4Info()
+        with open(p4info_fname, 'r') as f:
+            google.protobuf.text_format.Merge(f.read(), self.p4info)
+        # name -> P4Info object, for full names and unique suffixes
+        self.tables = self._index(self.p4info.tables)
+        self.actions = self._index(self.p4info.actions)
+
+        self.channel = grpc.insecure_channel(grpc_addr)
+        self.stub = p4runtime_pb2_grpc.P4RuntimeStub(self.channel)
+        self._stream_out_q = queue.Queue()
+
+        def stream_req_iterator():
+            while True:
+                p = self._stream_out_q.get()
+                if p is None:
+                    break
+                yield p
+
+        self._stream = self.stub.StreamChannel(stream_req_iterator())
+        # Receives the arbitration responses, or the error that ended
+        # the stream
+        arbitration_q = queue.Queue()
+
+        def stream_recv():
+            try:
+                for rep in self._stream:
+                    if rep.WhichOneof('update') == 'arbitration':
+                        arbitration_q.put(rep)
+            except grpc.RpcError as e:
+                # Also raised when close() cancels the stream
+                arbitration_q.put(e)
+
+        self._recv_thread = threading.Thread(target=stream_recv,
+                                             daemon=True)
+        self._recv_thread.start()
+        req = p4runtime_pb2.StreamMessageRequest()
+        req.arbitration.device_id = device_id
+        req.arbitration.election_id.high = election_id[0]
+        req.arbitration.election_id.low = election_id[1]
+        self._stream_out_q.put(req)
+        try:
+            rep = arbitration_q.get(timeout=arbitration_timeout)
+        except queue.Empty:
+            self._close_stream()
+            raise TimeoutError("No arbitration response from %s in %s"
+                               " seconds" % (grpc_addr, arbitration_timeout))
+        if isinstance(rep, Exception):
+            self._close_stream()
+            raise rep
+        self.req = self._new_request()
+
+    @staticmethod
+    def _index(objs):
+        ret = {}
+        duplicates = set()
+        for obj in objs:
+            parts = obj.preamble.name.split(".")
+            for i in range(len(parts)):
+                suffix = ".".join(parts[i:])
+                if suffix in ret and i > 0:
+                    duplicates.add(suffix)
+                ret[suffix] = obj
+        for suffix in duplicates:
+            del ret[suffix]
+        return ret
+
+    def _new_request(self):
+        req = self.pb.WriteRequest()
+        req.device_id = self.device_id
+        req.election_id.high = self.election_id[0]
+        req.election_id.low = self.election_id[1]
+        return req
+
+    def _set_action(self, action, name, params):
+        a = self.actions[name]
+        action.action_id = a.preamble.id
+        param_ids = {p.name: p.id for p in a.params}
+        for p_name, v in params.items():
+            param = action.params.add()
+            param.param_id = param_ids[p_name]
+            param.value = encode_value(v)
+
+    def add_table_entry(self, e):
+        t = self.tables[e['table']]
+        default = e.get('default_action', False)
+        update = self.req.updates.add()
+        update.type = (self.pb.Update.MODIFY if default
+                       else self.pb.Update.INSERT)
+        te = update.entity.table_entry
+        te.table_id = t.preamble.id
+        if default:
+            te.is_default_action = True
+        mfs = {mf.name: mf for mf in t.match_fields}
+        MatchField = self.p4info_pb.MatchField
+        for mf_name, v in e.get('match', {}).items():
+            mf = mfs[mf_name]
+            m = te.match.add()
+            m.field_id = mf.id
+            if mf.match_type == MatchField.EXACT:
+                m.exact.value = encode_value(v)
+            elif mf.match_type == MatchField.LPM:
+                m.lpm.value = encode_value(v[0])
+                m.lpm.prefix_len = v[1]
+            elif mf.match_type == MatchField.TERNARY:
+                m.ternary.value = encode_value(v[0])
+                m.ternary.mask = encode_value(v[1])
+            elif mf.match_type == MatchField.RANGE:
+                m.range.low = encode_value(v[0])
+                m.range.high = encode_value(v[1])
+            elif mf.match_type == MatchField.OPTIONAL:
+                m.optional.value = encode_value(v)
+            else:
+                raise ValueError("Unsupported match type of field %s"
+                                 "" % (mf_name))
+        if 'priority' in e:
+            te.priority = e['priority']
+        if 'action_name' in e:
+            self._set_action(te.action.action, e['action_name'],
+                             e.get('action_params', {}))
+        self._maybe_flush()
+
+    def _set_replicas(self, entry, replicas):
+        for r in replicas:
+            replica = entry.replicas.add()
+            replica.egress_port = r['egress_port']
+            replica.instance = r.get('instance', 0)
+
+    def add_multicast_group_entry(self, e):
+        update = self.req.updates.add()
+        update.type = self.pb.Update.INSERT
+        pre = update.entity.packet_replication_engine_entry
+        mg = pre.multicast_group_entry
+        mg.multicast_group_id = e['multicast_group_id']
+        self._set_replicas(mg, e['replicas'])
+        self._maybe_flush()
+
+    def add_clone_session_entry(self, e):
+        update = self.req.updates.add()
+        update.type = self.pb.Update.INSERT
+        pre = update.entity.packet_replication_engine_entry
+        cs = pre.clone_session_entry
+        cs.session_id = e['clone_session_id']
+        cs.class_of_service = e.get('class_of_service', 0)
+        cs.packet_length_bytes = e.get('packet_length_bytes', 0)
+        self._set_replicas(cs, e['replicas'])
+        self._maybe_flush()
+
+    def add(self, entry_type, e):
+        getattr(self, 'add_' + entry_type)(e)
+
+    def _maybe_flush(self):
+        # 6 bytes: the most the tag and length of an update take
+        size = self.req.updates[-1].ByteSize() + 6
+        if (self._req_bytes + size > self.max_request_bytes and
+                len(self.req.updates) > 1):
+            # Send the update just added in the next request.
+            update = self.pb.Update()
+            update.CopyFrom(self.req.updates[-1])
+            del self.req.updates[-1]
+            self.flush()
+            self.req.updates.add().CopyFrom(update)
+        self._req_bytes += size
+        if len(self.req.updates) >= self.max_updates:
+            self.flush()
+
+    def flush(self):
+        if len(self.req.updates) == 0:
+            return
+        req = self.req
+        self.req = self._new_request()
+        self._req_bytes = 0
+        self.stub.Write(req)
+        self.num_requests += 1
+        self.num_updates += len(req.updates)
+
+    def _close_stream(self):
+        self._stream_out_q.put(None)
+        self._stream.cancel()
+        self._recv_thread.join()
+        self.channel.close()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close_stream()
+
+
+class DpdkControlLoader(object):
+    """Sends the entries of a runtime JSON file to a DPDK switch over
+    the Unix stream socket 'socket_path', see the top of this file.
+    Waits up to 'connect_timeout' seconds for the switch to create the
+    socket."""
+
+    def __init__(self, socket_path, max_updates=1000, connect_timeout=10):
+        self.max_updates = max_updates
+        self.num_updates = 0
+        self.num_requests = 0
+        self._lines = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            try:
+                self.sock.connect(socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    self.sock.close()
+                    raise
+                time.sleep(0.1)
+
+    def add(self, entry_type, e):
+        msg = dict(e)
+        msg['type'] = entry_type
+        self._lines.append(json.dumps(msg, separators=(',', ':')))
+        if len(self._lines) >= self.max_updates:
+            self.flush()
+
+    def flush(self):
+        if not self._lines:
+            return
+        self._lines.append("")
+        self.sock.sendall("\n".join(self._lines).encode())
+        self.num_requests += 1
+        self.num_updates += len(self._lines) - 1
+        self._lines = []
+
+    def close(self):
+        self.flush()
+        self.sock.sendall(b'{"type":"end"}\n')
+        self.sock.close()
+
+
+def load_runtime_json(fname, target=None, grpc_addr='localhost:50051',
+                      device_id=0, p4info_fname=None,
+                      control_socket=None, max_updates=1000,
+                      connect_timeout=10, default_target=None):
+    """Load the entries of the runtime JSON file 'fname' into a switch,
+    and return a dict with the number of 'updates' sent, in how many
+    'requests' (batches), and the time it took in 'seconds'.
+
+    'target' overrides the "target" key of the file, and
+    'default_target' is used if there is neither.  For a DPDK target
+    the entries are sent to the Unix socket 'control_socket', and
+    otherwise to the P4Runtime server at 'grpc_addr', with the P4Info
+    file 'p4info_fname', or the one named in the runtime JSON file.
+    'connect_timeout' is how long to wait for the control socket to
+    appear, or for the P4Runtime server to answer the arbitration
+    request."""
+    start = time.time()
+    loader = None
+    # Entries that came before the keys needed to create the loader
+    pending = []
+    header = {}
+    for key, value in iter_runtime_json(fname):
+        if key not in STREAMED_KEYS.values():
+            header[key] = value
+            continue
+        if loader is None:
+            t = target or header.get('target') or default_target
+            if t is None:
+                pending.append((key, value))
+                continue
+            if t == 'dpdk':
+                if control_socket is None:
+                    raise ValueError("%s: no control socket for DPDK"
+                                     " target" % (fname))
+                loader = DpdkControlLoader(control_socket, max_updates,
+                                           connect_timeout)
+            else:
+                p4info = p4info_fname or header.get('p4info')
+                if p4info is None:
+                    pending.append((key, value))
+                    continue
+                loader = P4RuntimeLoader(grpc_addr, device_id, p4info,
+                                         max_updates=max_updates,
+                                         arbitration_timeout=connect_timeout)
+            for k, v in pending:
+                loader.add(k, v)
+            pending = []
+        loader.add(key, value)
+    if pending:
+        # No "target" or "p4info" key in the whole file
+        raise ValueError("%s: cannot load entries without a target and a"
+                         " P4Info file" % (fname))
+    if loader is None:
+        return {'updates': 0, 'requests': 0, 'seconds': 0.0}
+    loader.close()
+    return {'updates': loader.num_updates, 'requests': loader.num_requests,
+            'seconds': time.time() - start}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('runtime_json', help='path to runtime json',
+                        type=str)
+    parser.add_argument('--target', type=str, required=False, default=None,
+                        help='override the target of the runtime json')
+    parser.add_argument('--grpc-addr', type=str, required=False,
+                        default='localhost:50051')
+    parser.add_argument('--device-id', type=int, required=False, default=0)
+    parser.add_argument('--p4info', type=str, required=False, default=None)
+    parser.add_argument('--control-socket', type=str, required=False,
+                        default=None)
+    parser.add_argument('--max-updates', type=int, required=False,
+                        default=1000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    stats = load_runtime_json(args.runtime_json, args.target,
+                              args.grpc_addr, args.device_id, args.p4info,
+                              args.control_socket, args.max_updates)
+    print("Loaded %d entries in %d batches in %.3f seconds"
+          % (stats['updates'], stats['requests'], stats['seconds']))
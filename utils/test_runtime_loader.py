@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright 2025-present National University of Singapore
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Run with: python3 -m unittest test_runtime_loader  (from this directory)
+
+import json
+import os
+import tempfile
+import unittest
+
+from runtime_loader import STREAMED_KEYS, iter_runtime_json
+
+
+class IterRuntimeJsonTest(unittest.TestCase):
+
+    def parse(self, text, chunk_size):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as f:
+            f.write(text)
+        try:
+            return list(iter_runtime_json(f.name, chunk_size))
+        finally:
+            os.unlink(f.name)
+
+    def check(self, obj):
+        text = json.dumps(obj)
+        expected = []
+        for key, value in obj.items():
+            if key in STREAMED_KEYS:
+                expected += [(STREAMED_KEYS[key], e) for e in value]
+            else:
+                expected.append((key, value))
+        for chunk_size in (1, 2, 3, 4, 5, 8, 16, 1 << 16):
+            self.assertEqual(self.parse(text, chunk_size), expected,
+                             "chunk_size %d" % (chunk_size))
+
+    def test_numbers_split_between_chunks(self):
+        self.check({"n": 1.5, "table_entries": [1, 2]})
+        self.check({"n": -12.25e-3, "m": 1e10, "table_entries": [10, -3.5]})
+
+    def test_entries(self):
+        self.check({
+            "target": "bmv2",
+            "p4info": "build/basic.p4.p4info.txt",
+            "table_entries": [
+                {"table": "MyIngress.ipv4_lpm",
+                 "match": {"hdr.ipv4.dstAddr": ["10.0.1.1", 32]},
+                 "action_name": "MyIngress.ipv4_forward",
+                 "action_params": {"dstAddr": "08:00:00:00:01:11",
+                                   "port": 1}},
+                {"table": "MyIngress.ipv4_lpm", "default_action": True,
+                 "action_name": "MyIngress.drop", "action_params": {}},
+            ],
+            "multicast_group_entries": [],
+            "done": None,
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()